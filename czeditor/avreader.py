@@ -1,75 +1,625 @@
+import os
+import threading
+from bisect import bisect_right
+from collections import deque
+from time import perf_counter
+
 import av
 import av.container
+import av.video.reformatter
 import czeditor.util.avhelper
 
 import numpy as np
 
 from PySide6.QtCore import QFileInfo
 
+from czeditor.util.cachehelper import fileKey, getCacheDirectory
+from czeditor.util.lrucache import cacheservice
+
+
+# How many frames the playback thread decodes ahead of the playhead
+PREFETCH_DEPTH = 8
+
+# Decoded RGBA frames of every video, keyed by (canonical path, frame index, scale level)
+VIDEO_FRAME_CACHE_BUDGET = 512*1024*1024
+videoframecache = cacheservice.namespace(
+    "videoframes", budget=VIDEO_FRAME_CACHE_BUDGET)
+
+
+# Packet level index of a video stream, stored next to other cached data so it only has to be built once per file.
+class PyAVKeyframeIndex:
+    VERSION = 2
+
+    def __init__(self, pts: np.ndarray, keyframe: np.ndarray):
+        # Both arrays are in demux (decode) order
+        self.pts = pts
+        self.keyframe = keyframe
+        # Presentation timestamps in display order, frame n is shown from framepts[n] until framepts[n+1].
+        # Exact for variable frame rate video, where frames are not evenly spaced.
+        self.framepts = np.unique(pts)
+        # Frame indices of the keyframes, sorted
+        self.keyframes = np.searchsorted(self.framepts, pts[keyframe])
+
+    # Demuxes the stream without decoding anything, returns None if aborted
+    @staticmethod
+    def build(container: av.container.InputContainer, stream, abort: threading.Event = None):
+        pts = []
+        keyframe = []
+        for packet in container.demux(stream):
+            if abort is not None and abort.is_set():
+                return None
+            if packet.size == 0:  # Flushing packets
+                continue
+            # Raw elementary streams have no presentation timestamps, the decode timestamp is the next best thing
+            timestamp = packet.pts if packet.pts is not None else packet.dts
+            if timestamp is None:
+                continue
+            pts.append(timestamp)
+            keyframe.append(packet.is_keyframe)
+        return PyAVKeyframeIndex(np.array(pts, dtype=np.int64), np.array(keyframe, dtype=bool))
+
+    @staticmethod
+    def path(filename: str) -> str:
+        return os.path.join(getCacheDirectory("keyframeindex"), fileKey(filename)+".npz")
+
+    @staticmethod
+    def load(filename: str):
+        try:
+            with np.load(PyAVKeyframeIndex.path(filename)) as data:
+                if int(data["version"]) != PyAVKeyframeIndex.VERSION:
+                    return None
+                return PyAVKeyframeIndex(data["pts"], data["keyframe"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, filename: str):
+        path = PyAVKeyframeIndex.path(filename)
+        temporarypath = path+".tmp"
+        with open(temporarypath, "wb") as file:
+            np.savez(file, version=PyAVKeyframeIndex.VERSION,
+                     pts=self.pts, keyframe=self.keyframe)
+        os.replace(temporarypath, path)
+
+    # Builds the index from a separate container and caches it
+    @staticmethod
+    def buildAndSave(filename: str, abort: threading.Event = None):
+        with av.open(QFileInfo(filename).canonicalFilePath()) as container:
+            index = PyAVKeyframeIndex.build(
+                container, container.streams.video[0], abort)
+        if index is not None:
+            try:
+                index.save(filename)
+            except OSError:
+                pass  # Not being able to cache it is not fatal
+        return index
+
+
+# The index of one file, loaded or built once for all of its readers.
+# Readers subscribe and get it as soon as it is available.
+class SharedKeyframeIndex:
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._abort = threading.Event()
+        self._thread = None
+        self.index = PyAVKeyframeIndex.load(filename)
+        self._done = self.index is not None
+        if not self._done:
+            self._thread = threading.Thread(target=self._build, daemon=True)
+            self._thread.start()
+
+    def _build(self):
+        try:
+            index = PyAVKeyframeIndex.buildAndSave(self._filename, self._abort)
+        except av.AVError:
+            index = None
+        with self._lock:
+            self.index = index
+            self._done = True
+            subscribers = self._subscribers
+            self._subscribers = []
+        if index is not None:
+            for publish in subscribers:
+                publish(index)
+
+    # Calls publish(index) right away if the index is there, otherwise from the indexing thread once it is built
+    def subscribe(self, publish):
+        with self._lock:
+            if not self._done:
+                self._subscribers.append(publish)
+                return
+        if self.index is not None:
+            publish(self.index)
+
+    def unsubscribe(self, publish):
+        with self._lock:
+            if publish in self._subscribers:
+                self._subscribers.remove(publish)
+
+    def close(self):
+        self._abort.set()
+
+
+# Exponential moving average used to keep track of decoding and seeking costs
+def mix(average: float, value: float, weight: float = 0.1) -> float:
+    return average+(value-average)*weight
+
 
 # PyAV video reader with intelligent seeking.
 class PyAVSeekableVideoReader:
 
-    def __init__(self, filename):
+    # Readers of the same file can share one index, a reader without one loads or builds its own
+    def __init__(self, filename, sharedindex: SharedKeyframeIndex = None):
         self._filename = filename
-        self._container: av.container.InputContainer = av.open(
-            QFileInfo(self._filename).canonicalFilePath())
+        self.path = QFileInfo(self._filename).canonicalFilePath()
+        self._container: av.container.InputContainer = av.open(self.path)
         self._stream = self._container.streams.video[0]
         self._currentFrame = 0
         self.frame_rate = float(self._stream.average_rate)
-        self._keyframes = []
+        self.resolution = (self._stream.codec_context.width,
+                           self._stream.codec_context.height)
         self._container.streams.video[0].thread_type = "AUTO"
-        self._stream.codec_context.skip_frame = "NONKEY"
-        for frame in self._container.decode(self._stream):
-            self._keyframes.append(
-                int(frame.pts*self._stream.time_base*self.frame_rate))
-        self._stream.codec_context.skip_frame = "DEFAULT"
-        self._container.seek(0)
-        theframe = next(self._container.decode(
-            self._stream)).to_ndarray(format="rgb24")
-        self._cachedFrame = np.full(
-            (theframe.shape[0], theframe.shape[1], 4), 255, dtype=np.uint8)
-        self._cachedFrame[:, :, :3] = theframe
+        # Keeps its swscale context between frames instead of creating one per frame
+        self._reformatter = av.video.reformatter.VideoReformatter()
+        # Frames are scaled down by 2**level during conversion, level 0 is full resolution
+        self._level = 0
+        self._lastDecoded = None
+        # RGBA image of _lastDecoded, None until something asks for it
+        self._cachedFrame = None
+        # The reader can be shared by several keyframes and used from the seeking thread
+        self._lock = threading.RLock()
+        # Frames decoded ahead of the playhead during playback, as (frame index, RGBA frame from swscale).
+        # They are copied out of swscale's frame only once shown, straight into the upload buffer when possible.
+        self._prefetchQueue = deque()
+        self._prefetchCondition = threading.Condition(self._lock)
+        # Every prefetch worker gets its own stop event, a worker that was stopped never runs again
+        # even if playback restarts before it noticed
+        self._stopPrefetching = None
+        self._prefetchThread = None
+        # Seconds per decoded frame and per seek, measured as the reader is used
+        self._decodeCost = 1/240
+        self._seekCost = 1/60
+        self.stats = {"seeks": 0, "framesdecoded": 0,
+                      "framesdiscarded": 0, "cachehits": 0, "prefetchhits": 0}
+        # Frames are served right away, the index is published once it is available
+        self._index = None
+        self._keyframes = None
+        self._startpts = self._stream.start_time or 0
+        self._ownsIndex = sharedindex is None
+        self._sharedIndex = sharedindex or SharedKeyframeIndex(self._filename)
+        # Before the first decode, an index that is already there changes no frame numbers
+        self._sharedIndex.subscribe(self._publishIndex)
+        self._lastDecoded = next(self._container.decode(self._stream))
+
+    def _publishIndex(self, index: PyAVKeyframeIndex):
+        if (len(index.framepts) == 0):
+            # Nothing in the stream had a timestamp, frames keep being numbered from the frame rate
+            return
+        with self._lock:
+            if (self._index is None and self._lastDecoded is not None):
+                # Frames were numbered from the average frame rate until now, which is off for variable frame rate video
+                self._dropPrefetched()
+                videoframecache.discard(
+                    lambda key, value: key[0] == self.path)
+                if (self._lastDecoded is not None and self._lastDecoded.pts is not None):
+                    self._currentFrame = int(np.searchsorted(
+                        index.framepts, self._lastDecoded.pts))
+                    if (self._cachedFrame is not None):
+                        videoframecache.put(
+                            (self.path, self._currentFrame, self._level), self._cachedFrame)
+            self._index = index
+            self._keyframes = index.keyframes.tolist()
+
+    @property
+    def indexed(self) -> bool:
+        return self._keyframes is not None
+
+    # Frame index of a decoded frame's timestamp
+    def frameIndex(self, pts: int) -> int:
+        if (self._index is not None):
+            return int(np.searchsorted(self._index.framepts, pts))
+        return int((pts-self._startpts)*self._stream.time_base*self.frame_rate)
+
+    # Timestamp of a frame index, in stream time base
+    def framePts(self, frame: int) -> int:
+        if (self._index is not None):
+            return int(self._index.framepts[min(frame, len(self._index.framepts)-1)])
+        return self._startpts+int(frame/self._stream.time_base/self.frame_rate)
+
+    # Frame shown at a time in seconds from the start of the video
+    def frameAt(self, seconds: float) -> int:
+        if (self._index is not None):
+            pts = self._startpts+seconds/self._stream.time_base
+            return max(0, int(np.searchsorted(self._index.framepts, pts, side="right"))-1)
+        return int(seconds*self.frame_rate)
+
+    # Length of the video in seconds
+    @property
+    def duration(self) -> float:
+        if (self._index is not None and len(self._index.framepts)):
+            # The last frame is shown for about one average frame
+            return float((self._index.framepts[-1]-self._startpts)*self._stream.time_base)+1/self.frame_rate
+        if (self._stream.duration is not None):
+            return float(self._stream.duration*self._stream.time_base)
+        if (self._container.duration is not None):
+            return self._container.duration/av.time_base
+        return self._stream.frames/self.frame_rate
+
+    # Resolution of the frames given out at a scale level
+    def levelResolution(self, level: int) -> tuple:
+        return (max(1, self.resolution[0] >> level), max(1, self.resolution[1] >> level))
+
+    # Converts straight to RGBA with swscale, scaling to the current level
+    def _reformat(self, decodedFrame: av.VideoFrame) -> av.VideoFrame:
+        width, height = self.levelResolution(self._level)
+        return self._reformatter.reformat(
+            decodedFrame, width=width, height=height, format="rgba")
+
+    # Copies swscale's output into out, or into a new array if out is None.
+    # PyAV cannot make swscale write into memory it does not own, so this one copy is left.
+    def _copyPlane(self, rgbaFrame: av.VideoFrame, out: np.ndarray = None) -> np.ndarray:
+        plane = rgbaFrame.planes[0]
+        width, height = rgbaFrame.width, rgbaFrame.height
+        rgba = np.empty((height, width, 4),
+                        dtype=np.uint8) if out is None else out
+        # Rows of the plane can be padded, so only copy the visible part
+        rows = np.frombuffer(plane, dtype=np.uint8).reshape(
+            height, plane.line_size)
+        np.copyto(rgba.reshape(height, width*4), rows[:, :width*4])
+        return rgba
+
+    def _toRGBA(self, decodedFrame: av.VideoFrame, out: np.ndarray = None) -> np.ndarray:
+        return self._copyPlane(self._reformat(decodedFrame), out)
+
+    # RGBA image of the frame the decoder is at, converted the first time it is asked for
+    def _currentRGBA(self) -> np.ndarray:
+        if (self._cachedFrame is None):
+            self._cachedFrame = videoframecache.put(
+                (self.path, self._currentFrame, self._level), self._toRGBA(self._lastDecoded))
+        return self._cachedFrame
+
+    # Drops frames read ahead that were never handed out
+    def _dropPrefetched(self, keep: int = None):
+        while (self._prefetchQueue and (keep is None or self._prefetchQueue[0][0] < keep)):
+            self._prefetchQueue.popleft()
 
     def seekForward(self, frame: int):
         self._currentFrame = frame
+        starttime = perf_counter()
+        decoded = 0
+        decodedFrame = None  # Stays None past the end of the stream
         for decodedFrame in self._container.decode(self._stream):
-            if (int(decodedFrame.pts*self._stream.time_base*self.frame_rate) < frame):
+            decoded += 1
+            if (decodedFrame.pts is None):
+                decodedIndex = frame
+            else:
+                decodedIndex = self.frameIndex(decodedFrame.pts)
+            if (decodedIndex < frame):
+                self.stats["framesdiscarded"] += 1
+                # Keep the frames right before the target around, they are the likeliest to be scrubbed to next
+                if (frame-decodedIndex <= self.frame_rate and (self.path, decodedIndex, self._level) not in videoframecache):
+                    videoframecache.put(
+                        (self.path, decodedIndex, self._level), self._toRGBA(decodedFrame))
                 continue
-            return decodedFrame
-        else:
-            return decodedFrame
+            break
+        self.stats["framesdecoded"] += decoded
+        if (decodedFrame is not None):
+            self._lastDecoded = decodedFrame
+            self._cachedFrame = None
+        if decoded:
+            self._decodeCost = mix(self._decodeCost,
+                                   (perf_counter()-starttime)/decoded)
+        return decodedFrame
 
     def seek(self, frame: int) -> av.VideoFrame:
-        if (self._currentFrame == frame):
-            return self._cachedFrame
-        self._container.seek(
-            int(frame/self._stream.time_base/self.frame_rate), stream=self._stream)
+        starttime = perf_counter()
+        # Seeks to the keyframe at or before the frame's exact timestamp
+        self._container.seek(self.framePts(frame), stream=self._stream)
+        self._seekCost = mix(self._seekCost, perf_counter()-starttime)
+        self.stats["seeks"] += 1
         return self.seekForward(frame)
 
-    def __getitem__(self, frame: int):
+    # Returns the frame of the keyframe that starts the GOP containing the given frame
+    def gopStart(self, frame: int) -> int:
+        i = bisect_right(self._keyframes, frame)
+        return self._keyframes[i-1] if i else 0
+
+    # Decides whether decoding forward or seeking to the GOP of the frame is cheaper
+    def _shouldSeek(self, frame: int) -> bool:
         if (frame < self._currentFrame):
-            self._cachedFrame[:, :, :3] = self.seek(
-                frame).to_ndarray(format="rgb24")
-        if (frame > self._currentFrame):
-            for i in self._keyframes:
-                if i < frame and i > self._currentFrame:
-                    self._cachedFrame[:, :, :3] = self.seek(
-                        frame).to_ndarray(format="rgb24")
-                    break
-                elif i > frame:
-                    self._cachedFrame[:, :, :3] = self.seekForward(
-                        frame).to_ndarray(format="rgb24")
+            return True
+        if (self._keyframes is None):
+            # Without an index just seek, unless the frame is close enough to decode towards
+            return frame-self._currentFrame > self.frame_rate
+        gopstart = self.gopStart(frame)
+        if (gopstart <= self._currentFrame):  # Already inside the GOP
+            return False
+        forwardcost = (frame-self._currentFrame)*self._decodeCost
+        seekcost = self._seekCost+(frame-gopstart)*self._decodeCost
+        return seekcost < forwardcost
+
+    # Starts or stops decoding ahead of the playhead
+    def setPlaying(self, playing: bool):
+        if (playing and self._prefetchThread is None):
+            self._stopPrefetching = threading.Event()
+            self._prefetchThread = threading.Thread(
+                target=self._prefetch, args=(self._stopPrefetching,), daemon=True)
+            self._prefetchThread.start()
+        elif (not playing and self._prefetchThread is not None):
+            with self._lock:
+                self._stopPrefetching.set()
+                self._dropPrefetched()
+                self._prefetchCondition.notify_all()
+            self._prefetchThread = None
+
+    def _prefetch(self, stopped: threading.Event):
+        while not stopped.is_set():
+            # The lock is released after every frame so the paint thread is never blocked for long
+            with self._lock:
+                if (stopped.is_set()):
                     break
+                if (len(self._prefetchQueue) >= PREFETCH_DEPTH):
+                    self._prefetchCondition.wait()
+                    continue
+                frame = self._currentFrame+1
+                decodedFrame = self.seekForward(frame)
+                if (decodedFrame is None):  # Reached the end, wait for a seek
+                    self._currentFrame = frame-1
+                    self._prefetchCondition.wait()
+                    continue
+                self._prefetchQueue.append(
+                    (frame, self._reformat(decodedFrame)))
+
+    # Returns swscale's frame if it was decoded ahead, drops the queue otherwise
+    def _popPrefetched(self, frame: int):
+        self._dropPrefetched(frame)
+        self._prefetchCondition.notify_all()
+        if (self._prefetchQueue and self._prefetchQueue[0][0] == frame):
+            self.stats["prefetchhits"] += 1
+            return self._prefetchQueue[0][1]
+        # The playhead moved somewhere that was not read ahead, so this is a seek
+        self._dropPrefetched()
+        return None
+
+    def __getitem__(self, frame: int):
+        return self.read(frame)
+
+    # Returns the frame scaled down by 2**level
+    def read(self, frame: int, level: int = 0):
+        with self._lock:
+            if (level != self._level):
+                # Frames read ahead are at the wrong size now
+                self._dropPrefetched()
+                self._level = level
+                self._cachedFrame = None
+            if (self._prefetchQueue):
+                prefetched = self._popPrefetched(frame)
+                if (prefetched is not None):
+                    return videoframecache.getorcreate((self.path, frame, level), lambda: self._copyPlane(prefetched))
+            if (frame == self._currentFrame):
+                self.stats["cachehits"] += 1
+                return self._currentRGBA()
+            if (self._shouldSeek(frame)):
+                self.seek(frame)
             else:
-                self._cachedFrame[:, :, :3] = self.seekForward(
-                    frame).to_ndarray(format="rgb24")
-        return self._cachedFrame
+                self.seekForward(frame)
+            self._prefetchCondition.notify_all()
+            return self._currentRGBA()
+
+    # Writes the frame scaled down by 2**level into out, which is shaped like levelResolution(level).
+    # out is meant to be a mapped upload buffer: frames that were not converted yet are copied from swscale's output
+    # straight into it and are not cached, which saves copying them into an array first.
+    def readinto(self, frame: int, out: np.ndarray, level: int = 0) -> np.ndarray:
+        with self._lock:
+            image = videoframecache.get((self.path, frame, level))
+            if (image is None and level == self._level):
+                if (self._prefetchQueue):
+                    prefetched = self._popPrefetched(frame)
+                    if (prefetched is not None):
+                        return self._copyPlane(prefetched, out)
+                if (frame == self._currentFrame):
+                    self.stats["cachehits"] += 1
+                    if (self._cachedFrame is None):
+                        return self._toRGBA(self._lastDecoded, out)
+                    image = self._cachedFrame
+                else:
+                    if (self._shouldSeek(frame)):
+                        decodedFrame = self.seek(frame)
+                    else:
+                        decodedFrame = self.seekForward(frame)
+                    self._prefetchCondition.notify_all()
+                    if (decodedFrame is not None):
+                        return self._toRGBA(decodedFrame, out)
+                    image = self._currentRGBA()
+            if (image is None):
+                image = self.read(frame, level)
+        np.copyto(out, image)
+        return out
+
+    # The real amount of frames once indexed, many containers do not store it
+    def __len__(self):
+        if (self._index is not None):
+            return len(self._index.framepts)
+        if (self._stream.frames):
+            return self._stream.frames
+        return int(self.duration*self.frame_rate)
+
+    def close(self):
+        self._sharedIndex.unsubscribe(self._publishIndex)
+        if (self._ownsIndex):
+            self._sharedIndex.close()
+        self.setPlaying(False)
+        with self._lock:
+            self._container.close()
+
 
+# Fixed size FIFO of interleaved samples, the oldest samples are overwritten once it is full
+class SampleRingBuffer:
+    def __init__(self, capacity: int, channels: int):
+        self._samples = np.zeros((capacity, channels), dtype=np.float32)
+        self._head = 0
+        self.capacity = capacity
+        self.count = 0
+        # Sample index of the oldest sample in the buffer
+        self.start = 0
+
+    def reset(self, start: int):
+        self._head = 0
+        self.count = 0
+        self.start = start
+
+    @property
+    def end(self) -> int:
+        return self.start+self.count
+
+    def append(self, samples: np.ndarray):
+        if (len(samples) >= self.capacity):
+            self.reset(self.end+len(samples)-self.capacity)
+            samples = samples[-self.capacity:]
+        tail = (self._head+self.count) % self.capacity
+        first = min(len(samples), self.capacity-tail)
+        self._samples[tail:tail+first] = samples[:first]
+        self._samples[:len(samples)-first] = samples[first:]
+        overflow = max(0, self.count+len(samples)-self.capacity)
+        self._head = (self._head+overflow) % self.capacity
+        self.start += overflow
+        self.count += len(samples)-overflow
+
+    # Copies samples [sample, sample+len(out)) into out, they have to be in the buffer
+    def copyto(self, sample: int, out: np.ndarray):
+        indices = (self._head+sample-self.start +
+                   np.arange(len(out))) % self.capacity
+        np.take(self._samples, indices, axis=0, out=out)
+
+
+# PyAV audio reader that resamples everything to the same rate and layout.
+# Reading forward continues decoding, reading elsewhere seeks the demuxer to the packet before the sample.
+class PyAVAudioReader:
+    # Seeking is only worth it when the sample is further ahead than this
+    SEEK_THRESHOLD = 2
+    # Seconds before the sample that a seek lands at, at least a few codec frames
+    SEEK_PREROLL = 0.1
+
+    def __init__(self, filename, samplerate=48000, channels=2):
+        self.path = QFileInfo(filename).canonicalFilePath()
+        self.samplerate = samplerate
+        self.channels = channels
+        self._container: av.container.InputContainer = av.open(self.path)
+        self._stream = self._container.streams.audio[0] if self._container.streams.audio else None
+        self._lock = threading.Lock()
+        self._buffer = SampleRingBuffer(
+            samplerate*self.SEEK_THRESHOLD*2, channels)
+        self._decoder = None
+        self._resampler = None
+        # Frames still to be thrown away after a seek
+        self._discard = 0
+        self.stats = {"seeks": 0, "samplesdecoded": 0}
+        if (self._stream is not None):
+            self._startpts = self._stream.start_time or 0
+            self._stream.thread_type = "AUTO"
+            # Starts decoding from the beginning like a linear decode, without seeking
+            self._restart()
+
+    # Length of the audio in samples at the output rate
     def __len__(self):
-        return self._stream.frames
+        if (self._stream is None):
+            return 0
+        if (self._stream.duration is not None):
+            return int(self._stream.duration*self._stream.time_base*self.samplerate)
+        return int((self._container.duration or 0)/av.time_base*self.samplerate)
+
+    # Seeks a bit before the sample. Codecs like AAC overlap every frame with the one before it,
+    # so the first frame decoded after a seek is wrong and is thrown away.
+    def _seek(self, sample: int):
+        start = sample-int(self.SEEK_PREROLL*self.samplerate)
+        if (start > 0):
+            self._container.seek(
+                self._startpts+int(start/self.samplerate/self._stream.time_base), stream=self._stream)
+        else:
+            # Near the beginning there is nothing to overlap with, the same as a linear decode
+            self._container.seek(self._startpts, stream=self._stream)
+        self._restart()
+        self._discard = 1 if start > 0 else 0
+        self.stats["seeks"] += 1
+
+    def _restart(self):
+        self._decoder = self._container.decode(self._stream)
+        self._resampler = av.AudioResampler(
+            format="flt", layout="stereo" if self.channels == 2 else "mono", rate=self.samplerate)
+        self._buffer.reset(None)
+        self._discard = 0
+
+    # Decodes one frame into the buffer, returns False at the end of the stream
+    def _decodeNext(self) -> bool:
+        decodedFrame = next(self._decoder, None)
+        if (decodedFrame is None):
+            return False
+        if (self._discard):
+            self._discard -= 1
+            return True
+        if (self._buffer.start is None):
+            # The demuxer lands on the packet before the sample, the decoded position comes from its timestamp
+            self._buffer.reset(round(
+                (decodedFrame.pts-self._startpts)*self._stream.time_base*self.samplerate) if decodedFrame.pts is not None else 0)
+        for resampledFrame in self._resampler.resample(decodedFrame):
+            samples = resampledFrame.to_ndarray().reshape(-1, self.channels)
+            self._buffer.append(samples)
+            self.stats["samplesdecoded"] += len(samples)
+        return True
+
+    # Returns count samples starting at sample as float32, with silence outside the audio
+    def read(self, sample: int, count: int = 512) -> np.ndarray:
+        out = np.zeros((count, self.channels), dtype=np.float32)
+        if (self._stream is None):
+            return out
+        with self._lock:
+            first = max(sample, 0)
+            if (self._buffer.start is None or first < self._buffer.start or first > self._buffer.end+self.SEEK_THRESHOLD*self.samplerate):
+                self._seek(first)
+            while (self._buffer.start is None or self._buffer.end < sample+count):
+                if (not self._decodeNext()):
+                    break
+            if (self._buffer.start is None):
+                return out
+            # The buffer can start after the sample if the seek overshot, that part stays silent
+            first = max(first, self._buffer.start)
+            last = min(sample+count, self._buffer.end)
+            if (last > first):
+                self._buffer.copyto(first, out[first-sample:last-sample])
+        return out
+
+    def close(self):
+        with self._lock:
+            self._container.close()
+
+
+# Encodes audio as it arrives instead of all at once, the format follows the extension (.flac or .wav)
+class PyAVAudioStreamWriter:
+    def __init__(self, filename, samplerate=48000, channels=1):
+        self._container = av.open(filename, "w")
+        codec = "pcm_s16le" if os.path.splitext(filename)[1] == ".wav" else "flac"
+        self._stream = self._container.add_stream(codec, samplerate)
+        self._stream.channels = channels
+        self._stream.sample_rate = samplerate
+        self._layout = "mono" if channels == 1 else "stereo"
+        self._samplerate = samplerate
+        self._pts = 0
+
+    # Takes (samples, channels) float samples in -1..1
+    def write(self, samples: np.ndarray):
+        interleaved = (np.clip(samples, -1, 1)*32767).astype(np.int16)
+        frame = av.AudioFrame.from_ndarray(
+            interleaved.reshape(1, -1), format="s16", layout=self._layout)
+        frame.sample_rate = self._samplerate
+        frame.pts = self._pts
+        self._pts += len(samples)
+        for packet in self._stream.encode(frame):
+            self._container.mux(packet)
 
     def close(self):
+        for packet in self._stream.encode():
+            self._container.mux(packet)
         self._container.close()
 
 
@@ -0,0 +1,119 @@
+import os
+import threading
+import weakref
+from datetime import datetime
+
+import numpy as np
+import sounddevice
+
+from czeditor.avreader import PyAVAudioStreamWriter
+from czeditor.util.cachehelper import getCacheDirectory
+
+
+# Single producer ring buffer of samples that any number of readers follow with their own cursor.
+# The producer only ever advances written after the samples are in place, so neither side takes a lock.
+class CaptureRingBuffer:
+    def __init__(self, capacity: int, channels: int):
+        self._samples = np.zeros((capacity, channels), dtype=np.float32)
+        self.capacity = capacity
+        # Total samples ever written, the write position is written % capacity
+        self.written = 0
+
+    def write(self, samples: np.ndarray):
+        start = self.written % self.capacity
+        first = min(len(samples), self.capacity-start)
+        self._samples[start:start+first] = samples[:first]
+        self._samples[:len(samples)-first] = samples[first:]
+        self.written += len(samples)
+
+    # Copies the samples from cursor up to at most len(out) into out, returns the new cursor and how many were copied.
+    # A reader that fell more than the capacity behind skips ahead to the oldest samples still there.
+    def read(self, cursor: int, out: np.ndarray) -> tuple:
+        written = self.written
+        cursor = max(cursor, written-self.capacity)
+        count = min(len(out), written-cursor)
+        start = cursor % self.capacity
+        first = min(count, self.capacity-start)
+        out[:first] = self._samples[start:start+first]
+        out[first:count] = self._samples[:count-first]
+        return cursor+count, count
+
+
+# Continuously records from the default input device.
+# The live signal is read without blocking, and the whole take is written to disk as it comes in.
+# The take is only a finished file once the capture is closed, which also happens when it is garbage collected.
+class AudioCapture:
+    def __init__(self, outputpath: str, samplerate=48000, channels=1, blocksize=512):
+        self.samplerate = samplerate
+        self.channels = channels
+        self.blocksize = blocksize
+        self.outputpath = outputpath
+        self._ring = ring = CaptureRingBuffer(samplerate*10, channels)
+        self._readcursor = 0
+        stopped = threading.Event()
+        writer = PyAVAudioStreamWriter(outputpath, samplerate, channels)
+        writerThread = threading.Thread(
+            target=_writeToDisk, args=(ring, writer, stopped, samplerate//10, channels), daemon=True)
+        writerThread.start()
+        # Nothing the stream or the thread holds refers back to the capture, so it can be collected while recording
+        stream = sounddevice.InputStream(
+            samplerate=samplerate, channels=channels, blocksize=blocksize, dtype="float32",
+            callback=lambda indata, frames, time, status: ring.write(indata))
+        stream.start()
+        self._finalizer = weakref.finalize(
+            self, _stopCapture, stream, stopped, writerThread)
+
+    # Returns the next count samples, padded with silence if the device has not delivered them yet
+    def read(self, count: int = 512) -> np.ndarray:
+        out = np.empty((count, self.channels), dtype=np.float32)
+        # Stay close to live, a reader that was not called for a while drops what it missed
+        self._readcursor = max(
+            self._readcursor, self._ring.written-self.blocksize*4)
+        self._readcursor, copied = self._ring.read(self._readcursor, out)
+        # Silence where the device fell behind
+        out[copied:] = 0
+        return out
+
+    # Stops recording and finishes the file
+    def close(self):
+        self._finalizer()
+
+
+# Writes everything the ring buffer receives, the writer is closed once stopped is set and the ring is drained
+def _writeToDisk(ring: CaptureRingBuffer, writer: PyAVAudioStreamWriter, stopped: threading.Event, blocksize: int, channels: int):
+    block = np.zeros((blocksize, channels), dtype=np.float32)
+    cursor = 0
+    try:
+        while True:
+            done = stopped.wait(0.1)
+            copied = 1
+            while copied:
+                cursor, copied = ring.read(cursor, block)
+                if copied:
+                    writer.write(block[:copied])
+            if done:
+                break
+    finally:
+        writer.close()
+
+
+def _stopCapture(stream, stopped: threading.Event, writerThread: threading.Thread):
+    stream.stop()
+    stream.close()
+    stopped.set()
+    writerThread.join()
+
+
+# Where takes go when the Record source has no path set
+def recordingpath() -> str:
+    return os.path.join(getCacheDirectory("recordings"), datetime.now().strftime("%Y-%m-%d %H-%M-%S")+".flac")
+
+
+# A path for a new take that never overwrites an earlier one, name.flac then name-2.flac, name-3.flac...
+def takepath(path: str) -> str:
+    name, extension = os.path.splitext(path)
+    take = 1
+    while os.path.exists(path):
+        take += 1
+        path = f"{name}-{take}{extension}"
+    return path
@@ -1,4 +1,5 @@
 import concurrent.futures
+import logging
 import sys
 import traceback
 from ctypes import c_void_p
@@ -25,7 +26,9 @@ from czeditor.actionfunctions import *
 from czeditor.ui import *
 from czeditor.util import *
 from czeditor.avreader import PyAVAudioWriter
+from czeditor.openglfunctions import ResetUploadStats, uploadstats
 
+log = logging.getLogger(__name__)
 
 # TODO : Move these into the Window class
 
@@ -131,8 +134,11 @@ class CzeVideoView(QOpenGLWidget):
                              self.windowObject.cameraParams.y, self.windowObject.cameraParams.z)
         # print(projection)
         self.windowObject.rendering = True
+        ResetUploadStats()
         for keyframe in self.state:
             keyframe.composite(self.windowObject, self.spectrum, projection)
+        log.debug("Uploaded %d bytes in %d textures, skipped %d up to date textures",
+                  uploadstats["bytes"], uploadstats["uploads"], uploadstats["skipped"])
         glBindBuffer(GL_ARRAY_BUFFER, 0)
         glBindVertexArray(0)
 
@@ -339,6 +345,8 @@ class Window(QMainWindow):
         self.seeking = False
         self.skipfuturesobject = None
         self.rendering = False
+        # Set while exporting, sources use full quality media instead of previews
+        self.exporting = False
         self.currentspectrum = np.zeros(512)
         self.renderaudiobuffer = np.zeros(0)
         self.selectedAnimationFrame = None
@@ -401,13 +409,20 @@ class Window(QMainWindow):
     def render(self, filename, length):
         self.playbacksample = 0
         self.renderaudiobuffer = np.zeros(0)
-        clip = VideoClip(self.getframeimage, duration=length / 60)
-        audiowriter = PyAVAudioWriter(self.getframesound, "_tempaudio.mp3")
-        audiowriter.writeaudio(int(length/60*48000))
-        # clip.write_videofile(filename=filename, fps=60, codec="libx264rgb", ffmpeg_params=["-strict","-2"]) perfection, doesnt embed | don't delete this
-        clip.write_videofile(filename=filename, fps=60, codec="libvpx-vp9", ffmpeg_params=[
-            "-pix_fmt", "yuv444p", "-crf", "25", "-b:v", "0"], write_logfile=True, audio="_tempaudio.mp3")  # perfection, embeds only on pc
-        os.remove("_tempaudio.mp3")
+        self.exporting = True
+        try:
+            clip = VideoClip(self.getframeimage, duration=length / 60)
+            audiowriter = PyAVAudioWriter(
+                self.getframesound, "_tempaudio.mp3")
+            audiowriter.writeaudio(int(length/60*48000))
+            # clip.write_videofile(filename=filename, fps=60, codec="libx264rgb", ffmpeg_params=["-strict","-2"]) perfection, doesnt embed | don't delete this
+            clip.write_videofile(filename=filename, fps=60, codec="libvpx-vp9", ffmpeg_params=[
+                "-pix_fmt", "yuv444p", "-crf", "25", "-b:v", "0"], write_logfile=True, audio="_tempaudio.mp3")  # perfection, embeds only on pc
+            os.remove("_tempaudio.mp3")
+        finally:
+            self.exporting = False
+            # Sources like Record hold devices and files open until told to stop
+            self.stopplayback()
 
     def keyPressEvent(self, event: QKeyEvent) -> None:
         # print(event.text())
@@ -415,6 +430,8 @@ class Window(QMainWindow):
             self.isplaying = not self.isplaying
             self.starttime = perf_counter()
             self.startframe = self.playbackframe
+            if (not self.isplaying):
+                self.stopplayback()
         # elif event.text() == "r":
         #    self.render("renderedvideo.mp4",600)
         return super().keyPressEvent(event)
@@ -457,6 +474,15 @@ class Window(QMainWindow):
             self.playbackframe = frame
             self.playbacksample = int(frame/60*48000)
 
+    # Sources that only run during playback, like recording, release what they hold
+    def stopplayback(self):
+        for keyframe in self.keyframes:
+            if hasattr(keyframe.params.source.function(), "stop"):
+                try:
+                    keyframe.params.source.function().stop(keyframe.params.source.params)
+                except Exception:
+                    traceback.print_exc()
+
     def threadseek(self, frame):
 
         self.seeking = True
@@ -15,13 +15,6 @@ from czeditor.properties import *
 from czeditor.util import ParamLink, Params
 from czeditor.code_edit_window import CodeEditWindow
 
-imagecache = {}
-"""def cachecomposite(func,parentclass,width,height):
-    global imagecache
-    strparam = func.function().gethashstring(func.function(),func.params,parentclass)
-    if strparam not in imagecache:
-        imagecache[strparam] = func.function().image(func.params,parentclass).resize((width,height))
-    return imagecache[strparam]"""
 effectfunctionsdropdown = []
 
 
@@ -48,7 +41,7 @@ class Media2D(Effect):
 
         width, height = params.size()
 
-        imageResolution = (image.shape[1], image.shape[0])
+        imageResolution = keyframe.sourceResolution
 
         x, y = params.x(), params.y()
 
@@ -105,7 +98,7 @@ class Media3D(Effect):
 
         width, height = params.size()
 
-        imageResolution = (image.shape[1], image.shape[0])
+        imageResolution = keyframe.sourceResolution
 
         x, y, z = params.x(), params.y(), params.z()
 
@@ -294,6 +287,8 @@ class CustomColorShader(Effect):
 
 class CustomCode(Effect):
     name = "Custom Code"
+    # The code can read and change image on the CPU
+    usespixels = True
     params = Params({
         "code": StringProperty("")
     })
@@ -1,11 +1,16 @@
+import functools
 from math import ceil, floor
 
 import numpy as np
 import os
+import traceback
 
 from PIL import Image, ImageChops, ImageMath
 from PySide6.QtCore import QFileInfo
 
+from czeditor.util.cachehelper import getCacheDirectory, stableHash
+from czeditor.util.lrucache import cacheservice
+
 # _IMAGE = Image.new("RGBA", (200,100), (255,255,255,255))
 
 #  the put() command pastes an image onto a canvas where the given x,y coordinates dictate where the (0,0) point of the image should go.
@@ -261,15 +266,99 @@ def createtextmac(text, fontdirectory, color=(0, 0, 0, 255), buffersize=(3000, 3
     return drawntext.crop((0, 0, width, height))
 
 
-buffercache = {}
+buffercache = cacheservice.namespace("textbuffers")
 
 
 def getfromcache(cache, hash, default):
-    if hash in buffercache:
-        return buffercache[hash]
-    temp = default()
-    buffercache[hash] = temp
-    return temp
+    return cache.getorcreate(hash, default)
+
+
+windowcache = cacheservice.namespace("windows")
+# Generated windows are also kept as PNGs in the user cache, so they survive restarts
+WINDOW_DISK_CACHE = True
+# Bytes the windows saved in the user cache may take, the least recently used ones are deleted past it
+WINDOW_DISK_CACHE_BUDGET = 256*1024*1024
+# Part of every window's key, increase it when a generator draws differently so old images are not reused
+WINDOW_CACHE_VERSION = 1
+
+
+# Caches a window generator's images by a hash of its name and arguments.
+# Keyframes with the same parameters share one image, and changing a parameter back reuses the earlier one.
+def cachedwindow(generator):
+    @functools.wraps(generator)
+    def cached(*args, **kwargs):
+        try:
+            key = stableHash(generator.__name__,
+                             WINDOW_CACHE_VERSION, args, kwargs)
+        except TypeError:
+            return generator(*args, **kwargs)
+        images = windowcache.get(key)
+        if (images is None):
+            images = loadwindow(key) if WINDOW_DISK_CACHE else None
+            if (images is None):
+                images = generator(*args, **kwargs)
+                if (WINDOW_DISK_CACHE):
+                    savewindow(key, images)
+            windowcache.put(key, images)
+        # Callers are free to draw on the images they get
+        if isinstance(images, tuple):
+            return tuple(image.copy() for image in images)
+        return images.copy()
+    return cached
+
+
+# Each window is one compressed .npz holding image0, image1, ... so a window and its glass mask are saved and loaded together
+def savewindow(key, images):
+    directory = getCacheDirectory("windows")
+    path = os.path.join(directory, key+".npz")
+    arrays = images if isinstance(images, tuple) else (images,)
+    with open(path+".tmp", "wb") as file:
+        np.savez_compressed(file, tuple=isinstance(images, tuple),
+                            **{f"image{i}": np.asarray(image.convert("RGBA")) for i, image in enumerate(arrays)})
+    # Written under another name first, so a crash never leaves a broken window behind
+    os.replace(path+".tmp", path)
+    prunewindows(directory)
+
+
+# Anything that cannot be read counts as not cached
+def loadwindow(key):
+    path = os.path.join(getCacheDirectory("windows"), key+".npz")
+    if (not os.path.exists(path)):
+        return None
+    try:
+        with np.load(path) as data:
+            images = []
+            while f"image{len(images)}" in data:
+                images.append(Image.fromarray(
+                    data[f"image{len(images)}"], "RGBA"))
+            istuple = bool(data["tuple"])
+        if (not images or (not istuple and len(images) != 1)):
+            raise ValueError("Window has the wrong amount of images")
+    except Exception:
+        traceback.print_exc()
+        os.remove(path)
+        return None
+    # Recently used windows are the last to be pruned
+    os.utime(path)
+    return tuple(images) if istuple else images[0]
+
+
+# Deletes the least recently used windows until the folder fits in WINDOW_DISK_CACHE_BUDGET
+def prunewindows(directory):
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".npz"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if (total <= WINDOW_DISK_CACHE_BUDGET):
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
 
 
 def createtext7(im, x, y, text, fontdirectory, color=(0, 0, 0, 255), buffersize=(3000, 3000), align="00", kerningadjust=0, fit=9999999):
@@ -660,6 +749,7 @@ def Create2000Button(text, style=0, underline=False):
 # def CreateXPWindow(width,height,captiontext="",active=True,insideimagepath = "",erroriconpath="",errortext="",button1="",button2="",button3="",button1style=0,button2style=0,button3style=0):
 
 
+@cachedwindow
 def CreateXPWindow(param):
     width = 0
     height = 0
@@ -770,6 +860,7 @@ def CreateXPWindow(param):
     return IMAGE
 
 
+@cachedwindow
 def CreateMacAlertDialog(width, height, title="", bar=True, icon="", errortext="", subtext="", button1="", button2="", button3="", button1default=False, button2default=False, button3default=False, button1style=0, button2style=0, button3style=0):
     _paths = ["mac:Error Window With bar.png", "mac:Error Window No bar.png",
               "mac:Red Ridges.png", "mac:Button Outline.png"]
@@ -870,6 +961,7 @@ def CreateMacAlertDialog(width, height, title="", bar=True, icon="", errortext="
     return IMAGE
 
 
+@cachedwindow
 def CreateMacWindow(width, height, title="", icon="", errortext="", button1="", button2="", button3="", button1default=False, button2default=False, button3default=False, button1style=0, button2style=0, button3style=0):
     _paths = ["mac:Window With bar.png",
               "mac:Ridges.png", "mac:Button Outline.png"]
@@ -939,6 +1031,7 @@ def CreateMacWindow(width, height, title="", icon="", errortext="", button1="",
     return IMAGE
 
 
+@cachedwindow
 def CreateMacWindoid(icon="", text="", collapsed=False):
     _paths = ["mac:Windoid.png", "mac:Windoid Hidden.png", "mac:Studs.png",
               "mac:Windoid Close Button.png", "mac:Windoid Hide Button.png"]
@@ -1076,6 +1169,7 @@ def Create7Glass(width, height, active=True):
     return IMAGE, GlassMask
 
 
+@cachedwindow
 def Create7Window(icon="", text="", title="", active=True, buttons=[]):
     # print(time)
     # pos and screenres dictate the glass texture position and size on the window border
@@ -1220,6 +1314,7 @@ def Create7Window(icon="", text="", title="", active=True, buttons=[]):
         size = button.size"""  # tbd
 
 
+@cachedwindow
 def Create7TaskDialog(icon="", textbig="", textsmall="", title="", buttons=[], closebutton=True, active=True, pos=(200, 100), screenres=(1920, 1080), wallpaper=""):
     width = 360
     height = 0
@@ -1353,6 +1448,7 @@ def getsafe(a, i, fallback):
         return fallback
 
 
+@cachedwindow
 def Create3_1Window(icon="", text="", title="", buttons=[], active=True):
     contentwidth = 0
     contentheight = 0
@@ -1428,6 +1524,7 @@ def Create3_1Window(icon="", text="", title="", buttons=[], active=True):
     #
 
 
+@cachedwindow
 def CreateUbuntuWindow(icon="", bigtext="", text="", title="", buttons=[], active=True):
     contentwidth = 12+12+12
     contentheight = 12+16+24
@@ -1517,6 +1614,7 @@ def betterround(a):
         return ceil(a)
 
 
+@cachedwindow
 def Create95Window(icon="", text="", title="", buttons=[], active=True, closebutton=True):
     width = 0
     height = 0
@@ -1588,6 +1686,7 @@ def Create95Window(icon="", text="", title="", buttons=[], active=True, closebut
     return IMAGE
 
 
+@cachedwindow
 def Create98Window(icon="", text="", title="", buttons=[], active=True, closebutton=True, gradient1active=(0, 0, 128), gradient2active=(16, 132, 208), gradient1inactive=(128, 128, 128), gradient2inactive=(181, 181, 181)):
     width = 0
     height = 0
@@ -1669,6 +1768,7 @@ def Create98Window(icon="", text="", title="", buttons=[], active=True, closebut
     return IMAGE
 
 
+@cachedwindow
 def Create2000Window(icon="", text="", title="", buttons=[], active=True, closebutton=True):
     width = 0
     height = 0
@@ -1,11 +1,10 @@
 from PIL import Image
 
-rectangles = {}
+from czeditor.util.lrucache import cacheservice
+
+rectangles = cacheservice.namespace("rectangles")
 
 
 def CreateFilledRectangle(size, color):
     hash = str(size)+str(color)
-    if hash in rectangles:
-        return rectangles[hash]
-    rectangles[hash] = Image.new("RGBA", size, color)
-    return rectangles[hash]
+    return rectangles.getorcreate(hash, lambda: Image.new("RGBA", size, color))
@@ -0,0 +1,277 @@
+import concurrent.futures
+import glob
+import hashlib
+import os
+import re
+import threading
+import traceback
+from bisect import bisect_right
+from time import perf_counter
+
+import numpy as np
+import pyspng
+from PIL import Image
+
+from czeditor.util.cachehelper import getCacheDirectory
+from czeditor.util.lrucache import cacheservice
+
+try:
+    import zstandard
+except ImportError:  # Optional, packs are stored uncompressed without it
+    zstandard = None
+
+# How many frames after the playhead are loaded in advance
+SEQUENCE_PREFETCH_DEPTH = 12
+SEQUENCE_CACHE_BUDGET = 512*1024*1024
+# Missing frames make the folder get listed again, at most this often
+RESCAN_INTERVAL = 1
+
+sequenceframecache = cacheservice.namespace(
+    "imagesequences", budget=SEQUENCE_CACHE_BUDGET)
+
+
+def loadimage(path: str) -> np.ndarray:
+    if (os.path.splitext(path)[1] == ".png"):
+        with open(path, "rb") as file:
+            return pyspng.load(file.read())
+    return np.array(Image.open(path).convert("RGBA"))
+
+
+PACK_RAW = "raw"
+PACK_ZSTD = "zstd"
+# Choices for a sequence's frame cache, compression is only offered when zstandard is installed
+PACK_OPTIONS = [["Off", None], ["Raw", PACK_RAW]] + \
+    ([["Compressed (zstd)", PACK_ZSTD]] if zstandard is not None else [])
+
+# Per frame entry of a pack's index
+PACK_INDEX_DTYPE = np.dtype([("number", np.int64), ("offset", np.int64), ("length", np.int64),
+                             ("height", np.int32), ("width", np.int32), ("channels", np.int32)])
+
+
+# All frames of a sequence decoded once and stored back to back in one file, next to an index of offsets.
+# Raw frames are read straight from the memory map, zstd frames only need decompressing instead of PNG decoding.
+class PackedFrameCache:
+    def __init__(self, datapath: str, index: np.ndarray, compression: str):
+        self.compression = compression
+        self._rows = {int(row["number"]): row for row in index}
+        self._data = np.memmap(datapath, dtype=np.uint8,
+                               mode="r") if len(index) else None
+        self._decompressor = zstandard.ZstdDecompressor(
+        ) if compression == PACK_ZSTD else None
+
+    def __contains__(self, number: int) -> bool:
+        return number in self._rows
+
+    def read(self, number: int) -> np.ndarray:
+        row = self._rows[number]
+        chunk = self._data[row["offset"]:row["offset"]+row["length"]]
+        if (self._decompressor is not None):
+            chunk = np.frombuffer(
+                self._decompressor.decompress(chunk.tobytes()), dtype=np.uint8)
+        shape = (row["height"], row["width"], row["channels"]
+                 ) if row["channels"] else (row["height"], row["width"])
+        return chunk.reshape(shape)
+
+    # Files of a pack, named after the sequence files' paths, sizes and mtimes, so changing any frame makes a new pack
+    @staticmethod
+    def paths(frames: dict, compression: str) -> tuple:
+        digest = hashlib.sha1(compression.encode("utf-8"))
+        for number in sorted(frames):
+            stat = os.stat(frames[number])
+            digest.update(
+                f"{number}|{frames[number]}|{stat.st_size}|{stat.st_mtime_ns}\n".encode("utf-8"))
+        base = os.path.join(getCacheDirectory(
+            "sequencepacks"), digest.hexdigest())
+        return base+".frames", base+".index.npy"
+
+    @staticmethod
+    def load(frames: dict, compression: str):
+        datapath, indexpath = PackedFrameCache.paths(frames, compression)
+        if (not os.path.exists(indexpath)):
+            return None
+        return PackedFrameCache(datapath, np.load(indexpath), compression)
+
+    @staticmethod
+    def build(frames: dict, compression: str, abort: threading.Event):
+        datapath, indexpath = PackedFrameCache.paths(frames, compression)
+        compressor = zstandard.ZstdCompressor(
+            level=3) if compression == PACK_ZSTD else None
+        index = np.zeros(len(frames), dtype=PACK_INDEX_DTYPE)
+        offset = 0
+        with open(datapath+".tmp", "wb") as file:
+            for i, number in enumerate(sorted(frames)):
+                if (abort.is_set()):
+                    break
+                image = np.ascontiguousarray(loadimage(frames[number]))
+                chunk = image.tobytes() if compressor is None else compressor.compress(image.data)
+                file.write(chunk)
+                index[i] = (number, offset, len(chunk), image.shape[0], image.shape[1],
+                            image.shape[2] if image.ndim == 3 else 0)
+                offset += len(chunk)
+        if (abort.is_set()):
+            os.remove(datapath+".tmp")
+            return None
+        os.replace(datapath+".tmp", datapath)
+        # The index is written last, a pack only counts as built once it exists
+        with open(indexpath+".tmp", "wb") as file:
+            np.save(file, index)
+        os.replace(indexpath+".tmp", indexpath)
+        return PackedFrameCache(datapath, index, compression)
+
+
+# Loads the frames of a "name*.png" style sequence, where * is the frame number.
+# Frames after the one asked for are decoded ahead on a thread pool, and a seek cancels whatever was not started yet.
+class ImageSequenceLoader:
+    def __init__(self, pattern: str, packing: str = None, workers: int = 4):
+        self.pattern = pattern
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._lastscan = 0
+        self.frames = {}
+        # (size, mtime) of every frame's file when it was last scanned
+        self._stats = {}
+        self.numbers = []
+        # Packing happens on its own thread so it never delays prefetching
+        self._packExecutor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1)
+        self._packing = None
+        self._abortPacking = threading.Event()
+        self.packed = None
+        self.scan()
+        self.setpacking(packing)
+
+    # Resolves the pattern to the files that exist, once instead of on every frame
+    def scan(self):
+        prefix, _, suffix = self.pattern.partition("*")
+        expression = re.compile(re.escape(os.path.basename(prefix)) +
+                                r"(\d+)"+re.escape(suffix)+"$")
+        frames = {}
+        stats = {}
+        for path in glob.glob(glob.escape(prefix)+"*"+glob.escape(suffix)):
+            match = expression.match(os.path.basename(path))
+            if match is not None:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                frames[int(match.group(1))] = path
+                stats[int(match.group(1))] = (stat.st_size, stat.st_mtime_ns)
+        # Frames overwritten in place keep their path, so their size and mtime are compared too
+        changednumbers = {number for number in stats.keys() | self._stats.keys()
+                          if stats.get(number) != self._stats.get(number)}
+        self.frames = frames
+        self._stats = stats
+        self.numbers = sorted(frames)
+        self._lastscan = perf_counter()
+        if (changednumbers):
+            # Images decompressed from the old pack are cached without a path to check
+            sequenceframecache.discard(
+                lambda key, value: key[0] == self.pattern and key[1] in changednumbers)
+        if (changednumbers and self._packing is not None):
+            # The pack no longer matches the files, make a new one
+            self.setpacking(self._packing, True)
+
+    # True if the frame's file changed since the last scan
+    def _modified(self, frame: int) -> bool:
+        try:
+            stat = os.stat(self.frames[frame])
+        except OSError:
+            return True
+        return (stat.st_size, stat.st_mtime_ns) != self._stats.get(frame)
+
+    # Uses or builds a pack of the sequence with the given compression, or stops using one if None
+    def setpacking(self, compression: str, rebuild: bool = False):
+        if (compression == PACK_ZSTD and zstandard is None):
+            compression = PACK_RAW
+        if (compression == self._packing and not rebuild):
+            return
+        self._abortPacking.set()
+        self._abortPacking = threading.Event()
+        self._packing = compression
+        self.packed = None
+        if (compression is None or not self.frames):
+            return
+        try:
+            self.packed = PackedFrameCache.load(self.frames, compression)
+        except (OSError, ValueError):
+            traceback.print_exc()
+        if (self.packed is None):
+            self._packExecutor.submit(
+                self._pack, dict(self.frames), compression, self._abortPacking)
+
+    def _pack(self, frames: dict, compression: str, abort: threading.Event):
+        try:
+            packed = PackedFrameCache.build(frames, compression, abort)
+        except Exception:
+            traceback.print_exc()
+            return
+        if (packed is not None and not abort.is_set()):
+            self.packed = packed
+
+    def _load(self, number: int) -> np.ndarray:
+        packed = self.packed
+        if (packed is not None and number in packed):
+            if (packed.compression == PACK_RAW):
+                return packed.read(number)  # Already as cheap as a cache hit
+            return sequenceframecache.getorcreate((self.pattern, number), lambda: packed.read(number))
+        return sequenceframecache.getorcreate(
+            (self.pattern, number), lambda: loadimage(self.frames[number]), self.frames[number])
+
+    def _submit(self, number: int):
+        if (number not in self._futures and (self.pattern, number) not in sequenceframecache):
+            self._futures[number] = self._executor.submit(self._load, number)
+
+    def get(self, frame: int):
+        if ((frame not in self.frames and perf_counter()-self._lastscan > RESCAN_INTERVAL) or
+                (frame in self.frames and self._modified(frame))):
+            self.scan()
+        if (frame not in self.frames):
+            return None
+        with self._lock:
+            self._prefetch(frame)
+            future = self._futures.get(frame)
+        if (future is not None):
+            try:
+                return future.result()
+            except concurrent.futures.CancelledError:
+                pass  # Another keyframe using the sequence seeked
+        return self._load(frame)
+
+    def _prefetch(self, frame: int):
+        start = bisect_right(self.numbers, frame)
+        upcoming = set(self.numbers[start:start+SEQUENCE_PREFETCH_DEPTH])
+        for number, future in list(self._futures.items()):
+            if (future.done()):
+                del self._futures[number]
+            elif (number not in upcoming and number != frame):
+                # The playhead moved away, only running loads are kept
+                if future.cancel():
+                    del self._futures[number]
+        self._submit(frame)
+        for number in sorted(upcoming):
+            self._submit(number)
+
+    def close(self):
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures = {}
+        self._abortPacking.set()
+        self._executor.shutdown(wait=False)
+        self._packExecutor.shutdown(wait=False)
+
+
+sequenceloaders = {}
+
+
+# Loaders are shared by every keyframe using the same pattern and packing,
+# keyframes with different settings get their own instead of switching one back and forth
+def sequenceloader(pattern: str, packing: str = None) -> ImageSequenceLoader:
+    if (packing == PACK_ZSTD and zstandard is None):
+        packing = PACK_RAW
+    if (pattern, packing) not in sequenceloaders:
+        sequenceloaders[(pattern, packing)] = ImageSequenceLoader(
+            pattern, packing)
+    return sequenceloaders[(pattern, packing)]
@@ -1,3 +1,4 @@
+import concurrent.futures
 from ctypes import c_void_p
 from typing import overload
 
@@ -5,7 +6,7 @@ import numpy as np
 from OpenGL.GL import *
 from PySide6.QtGui import QMatrix4x4, QQuaternion
 
-from czeditor.customShaderCompilation import compileProgram
+from czeditor.customShaderCompilation import compileProgram, compileShader
 from czeditor.openglfunctions import *
 from czeditor.properties import LineStringProperty
 from czeditor.util import *
@@ -27,14 +28,49 @@ class Keyframe():
         self.shadersForDeletion = None
         self.currentTextureSize = None
         self.currentTexture = None
+        # Full resolution of the source, the image it gives can be smaller (for example a proxy)
+        self.sourceResolution = None
+        # Size the layer covered on screen last time it was drawn, sources can give a smaller image for it
+        self.displaySize = None
+        # Shown while a source's job for the current frame is still running
+        self.lastImage = None
+        self.pendingImage = None
         self.fbo = None
-        self.pbo = None
+        self.uploadRing = None
+        # The texture already holds this image, so it does not need uploading again.
+        # Sources never change an image they handed out, they return a new array instead.
+        self.uploadedImage = None
+        # Or the (reader, frame, level) decoded into it last
+        self.uploadedFrame = None
 
     def copy(self):
         return Keyframe(self.frame, self.layer, self.params.copy())
 
     def getImage(self, parentclass):  # TODO : Rename this to source
-        return self.params.source.function().image(self.params.source.params, parentclass, parentclass.playbackframe-self.frame)
+        source = self.params.source.function()
+        frame = parentclass.playbackframe-self.frame
+        # Exporting always gets full resolution images
+        if (self.displaySize is not None and not parentclass.exporting and hasattr(source, "previewimage")):
+            image = source.previewimage(
+                self.params.source.params, parentclass, frame, self.displaySize)
+        else:
+            image = source.image(self.params.source.params, parentclass, frame)
+        if (isinstance(image, concurrent.futures.Future)):
+            image = self.resolveImage(image, parentclass)
+        self.lastImage = image
+        return image
+
+    # Sources can return a future for slow work, the last image is drawn until it finishes
+    def resolveImage(self, future, parentclass):
+        # Exported frames have to be exact
+        if (parentclass.exporting or future.done()):
+            return future.result()
+        if (future is not self.pendingImage):
+            self.pendingImage = future
+            future.add_done_callback(lambda done: parentclass.updateviewport())
+        if (self.lastImage is None):
+            return np.zeros((1, 1, 4), dtype=np.uint8)
+        return self.lastImage
 
     def actOnKeyframes(self, keyframeToModify, windowClass):  # action
         for action in self.params.actions:
@@ -44,10 +80,40 @@ class Keyframe():
 
     def composite(self, windowObject, spectrum, projection):
 
-        if (not hasattr(self.params.source.function(), "image")):
+        procedural = None
+        decoding = None
+        # Effects that work on the pixels on the CPU need the real image, not one drawn or decoded on the GPU side
+        usesPixels = any(getattr(effect.function(), "usespixels", False)
+                         for effect in self.params.effects)
+        if (not usesPixels and hasattr(self.params.source.function(), "decodeframe")):
+            # Exporting always gets full resolution images
+            decoding = self.params.source.function().decodeframe(self.params.source.params, windowObject,
+                                                                 windowObject.playbackframe-self.frame, None if windowObject.exporting else self.displaySize)
+        if (not usesPixels and hasattr(self.params.source.function(), "procedural")):
+            # Drawn by a shader, there are no pixels to upload
+            procedural = self.params.source.function().procedural(
+                self.params.source.params, windowObject, windowObject.playbackframe-self.frame)
+            # Effects only look at the size of the image, this takes no memory
+            image = np.broadcast_to(np.zeros(4, dtype=np.uint8),
+                                    (procedural["height"], procedural["width"], 4))
+            imageDataPointer = None
+        elif (decoding is not None):
+            # Decoded straight into the upload buffer further down, effects only need the size
+            width, height = decoding[0].levelResolution(decoding[2])
+            image = np.broadcast_to(
+                np.zeros(4, dtype=np.uint8), (height, width, 4))
+            imageDataPointer = None
+        elif (not hasattr(self.params.source.function(), "image")):
             return
-        image = self.getImage(windowObject)
-        imageDataPointer = image.ctypes.data
+        else:
+            image = self.getImage(windowObject)
+            imageDataPointer = image.ctypes.data
+        self.sourceResolution = None
+        if (hasattr(self.params.source.function(), "resolution")):
+            self.sourceResolution = self.params.source.function().resolution(
+                self.params.source.params)
+        if (self.sourceResolution is None):
+            self.sourceResolution = (image.shape[1], image.shape[0])
 
         vertices = np.empty((0, 5), dtype=np.float32)
         shader = []
@@ -56,18 +122,25 @@ class Keyframe():
             if hasattr(effect.function(), "imageEffect"):
                 image, vertices, shader = effect.function().imageEffect(image, vertices, shader,
                                                                         effect.params, windowObject, self, windowObject.playbackframe-self.frame)
+        if (usesPixels):
+            # The effects may have replaced the image
+            image = np.ascontiguousarray(image, dtype=np.uint8)
+            imageDataPointer = image.ctypes.data
         if (not shader):
             return
+        self.displaySize = ProjectedSize(vertices, projection)
         vertices = vertices.flatten()
 
         if (self.fbo is None):
             self.fbo = glGenFramebuffers(1)
-        if (self.pbo is None):
-            self.pbo = glGenBuffers(1)
+        if (self.uploadRing is None):
+            self.uploadRing = PixelUploadRing()
         # glBindFramebuffer(GL_FRAMEBUFFER,self.fbo)
 
-        if (str(shader) != str(self.lastShaderList)):
-            self.lastShaderList = shader
+        shaderKey = str(shader) if procedural is None else str(
+            shader)+procedural["code"]
+        if (shaderKey != self.lastShaderList):
+            self.lastShaderList = shaderKey
             if (self.compiledPrograms):
 
                 for shaderForDeletion in self.shadersForDeletion:
@@ -85,6 +158,18 @@ class Keyframe():
 
             self.compiledPrograms = []
             self.shadersForDeletion = []
+            sourceShader = None
+            if (procedural is not None):
+                sourceShader = compileShader(
+                    procedural["code"], GL_FRAGMENT_SHADER)
+                self.shadersForDeletion.append(sourceShader)
+                if (any("ismultisample" in snippet for snippet in shader)):
+                    # Effects sample the texture, so the source is drawn into it by a first pass
+                    shaderslist, shadersForDeletion = GenerateShader(
+                        [], True, sourceShader)
+                    self.shadersForDeletion += shadersForDeletion
+                    self.compiledPrograms.append(compileProgram(*shaderslist))
+                    sourceShader = None
             shadersnippet = []
             i = 0
             for snippet in shader:
@@ -99,7 +184,7 @@ class Keyframe():
                     shadersnippet = []
                 elif (i == len(shader)-1):
                     shaderslist, shadersForDeletion = GenerateShader(
-                        shadersnippet, False)
+                        shadersnippet, False, sourceShader)
                     self.shadersForDeletion += shadersForDeletion
                     # print(f"SHADERS LIST {shaderslist}")
                     # print(shadersnippet)
@@ -108,13 +193,16 @@ class Keyframe():
                 i += 1
             # print("recompiled")
 
-        if (self.currentTexture == None):
+        # A procedural layer drawn in one pass needs no texture at all
+        usesTexture = procedural is None or len(self.compiledPrograms) > 1
+        if (usesTexture and self.currentTexture == None):
             self.currentTexture = glGenTextures(1)
             self.currentTextureSize = (0, 0)
 
-        glBindTexture(GL_TEXTURE_2D, self.currentTexture)
+        if (usesTexture):
+            glBindTexture(GL_TEXTURE_2D, self.currentTexture)
 
-        if (self.currentTextureSize[0] != image.shape[1] or self.currentTextureSize[1] != image.shape[0]):
+        if (usesTexture and (self.currentTextureSize[0] != image.shape[1] or self.currentTextureSize[1] != image.shape[0])):
 
             if (self.fbo):
                 glDeleteFramebuffers(1, [self.fbo])
@@ -136,18 +224,36 @@ class Keyframe():
             glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA,
                          image.shape[1], image.shape[0], 0, GL_RGBA, GL_UNSIGNED_BYTE, c_void_p(imageDataPointer))
             self.currentTextureSize = (image.shape[1], image.shape[0])
+            self.uploadedImage = None
+            self.uploadedFrame = None
+            if (imageDataPointer is not None):
+                self.uploadedImage = image
+                CountUpload(image.nbytes)
 
             glFramebufferTexture(
                 GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, self.currentTexture, 0)
 
             glDrawBuffers(1, [GL_COLOR_ATTACHMENT0])
             glBindFramebuffer(GL_FRAMEBUFFER, 0)
-        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, self.pbo)
-        UpdateTextureWithBuffer(
-            imageDataPointer, image.shape[0]*image.shape[1]*4, (image.shape[1], image.shape[0]))
-
-        # glTexSubImage2D(GL_TEXTURE_2D,0,0,0,image.shape[1],image.shape[0],GL_RGBA,GL_UNSIGNED_BYTE,c_void_p(imageDataPointer))
-        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        # Multisample passes draw into the texture, so it only stays valid for single pass layers
+        # Pixel effects can edit the image in place, so it is always uploaded with them
+        if (len(self.compiledPrograms) == 1 and not usesPixels and ((imageDataPointer is not None and image is self.uploadedImage) or
+                                                 (decoding is not None and decoding == self.uploadedFrame))):
+            CountSkippedUpload()
+        elif (decoding is not None):
+            reader, frame, level = decoding
+            reader.readinto(
+                frame, self.uploadRing.acquire(image.shape), level)
+            self.uploadRing.submit((image.shape[1], image.shape[0]))
+            self.uploadedImage = None
+            self.uploadedFrame = decoding
+            CountUpload(image.nbytes)
+        elif (procedural is None):
+            self.uploadRing.upload(
+                imageDataPointer, image.shape[0]*image.shape[1]*4, (image.shape[1], image.shape[0]))
+            self.uploadedImage = image
+            self.uploadedFrame = None
+            CountUpload(image.shape[0]*image.shape[1]*4)
 
         glBufferData(GL_ARRAY_BUFFER, np.array(
             vertices, dtype=np.float32), GL_DYNAMIC_DRAW)
@@ -181,6 +287,8 @@ class Keyframe():
                     program, "height"), image.shape[0])
                 glUniform1fv(glGetUniformLocation(
                     program, "spectrum"), 1024, spectrum)
+                if (procedural is not None and program == self.compiledPrograms[0]):
+                    SetUniforms(program, procedural["uniforms"])
 
                 glActiveTexture(GL_TEXTURE0)
                 glDrawArrays(GL_TRIANGLES, 0, 6)
@@ -208,6 +316,8 @@ class Keyframe():
             self.compiledPrograms[-1], "height"), image.shape[0])
         glUniform1fv(glGetUniformLocation(
             self.compiledPrograms[-1], "spectrum"), 1024, spectrum)
+        if (procedural is not None and not usesTexture):
+            SetUniforms(self.compiledPrograms[-1], procedural["uniforms"])
 
         glActiveTexture(GL_TEXTURE0)
         glDrawArrays(GL_TRIANGLES, 0, int(vertices.shape[0]/5))
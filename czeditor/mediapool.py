@@ -0,0 +1,132 @@
+import threading
+import weakref
+from time import perf_counter
+
+from PySide6.QtCore import QFileInfo
+
+from czeditor.avreader import PyAVAudioReader, PyAVSeekableVideoReader, SharedKeyframeIndex
+
+# How long unused media stays open in case a keyframe wants it again
+IDLE_TIMEOUT = 30
+
+
+class MediaPoolEntry:
+    def __init__(self, path):
+        self.path = path
+        # Loaded or built once, every reader of the file numbers its frames from it
+        self.index = SharedKeyframeIndex(path)
+        # Readers nobody leases right now, as (reader, time it was given back)
+        self.idlevideo = []
+        self.idleaudio = []
+        self.references = 0
+        self.lastreleased = perf_counter()
+
+    def openvideo(self) -> PyAVSeekableVideoReader:
+        return PyAVSeekableVideoReader(self.path, self.index)
+
+    def openaudio(self) -> PyAVAudioReader:
+        return PyAVAudioReader(self.path, 48000)
+
+    def giveback(self, readers: dict):
+        now = perf_counter()
+        self.idlevideo.append((readers["video"], now))
+        if (readers["audio"] is not None):
+            self.idleaudio.append((readers["audio"], now))
+        self.lastreleased = now
+
+    # Closes readers that have not been leased again within the timeout
+    def closeidle(self, now, timeout):
+        for idle in (self.idlevideo, self.idleaudio):
+            for reader, released in list(idle):
+                if now-released > timeout:
+                    idle.remove((reader, released))
+                    reader.close()
+
+    def close(self):
+        self.closeidle(float("inf"), -1)
+        self.index.close()
+
+
+# A keyframe's handle on pooled media. Released explicitly or when garbage collected.
+# Every lease decodes with its own readers, so keyframes showing the same file at different times don't seek each other around.
+class MediaLease:
+    def __init__(self, pool, entry: MediaPoolEntry, video: PyAVSeekableVideoReader):
+        self.entry = entry
+        self.video = video
+        self._pool = pool
+        # Handed back to the pool by the finalizer, which cannot refer to the lease itself
+        self._readers = {"video": video, "audio": None}
+        self._finalizer = weakref.finalize(
+            self, pool._release, entry, self._readers)
+
+    # Opened when first needed, proxies for example are never listened to
+    @property
+    def audio(self) -> PyAVAudioReader:
+        if (self._readers["audio"] is None):
+            self._readers["audio"] = self._pool._take(
+                self.entry, self.entry.idleaudio, self.entry.openaudio)
+        return self._readers["audio"]
+
+    def release(self):
+        self._finalizer()
+
+
+# Process wide pool of opened media files, keyed by canonical path.
+# Keyframes using the same file share the keyframe index and decoded frames, readers are reused once given back.
+class MediaPool:
+    def __init__(self, idletimeout=IDLE_TIMEOUT):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.idletimeout = idletimeout
+
+    def lease(self, filename) -> MediaLease:
+        path = QFileInfo(filename).canonicalFilePath()
+        with self._lock:
+            self._evictIdle()
+            entry = self._entries.get(path)
+            if entry is None:
+                entry = MediaPoolEntry(path)
+                self._entries[path] = entry
+            entry.references += 1
+        try:
+            video = self._take(entry, entry.idlevideo, entry.openvideo)
+        except Exception:
+            with self._lock:
+                entry.references -= 1
+            raise
+        return MediaLease(self, entry, video)
+
+    # An idle reader if there is one, opening a file takes long so a new one is opened outside the lock
+    def _take(self, entry: MediaPoolEntry, idle: list, open):
+        with self._lock:
+            if idle:
+                return idle.pop()[0]
+        return open()
+
+    def _release(self, entry: MediaPoolEntry, readers: dict):
+        with self._lock:
+            entry.references -= 1
+            entry.giveback(readers)
+            self._evictIdle()
+
+    # Closes media that has been unused for longer than the idle timeout, called periodically by the timeline
+    def sweep(self):
+        with self._lock:
+            self._evictIdle()
+
+    def _evictIdle(self):
+        now = perf_counter()
+        for path, entry in list(self._entries.items()):
+            entry.closeidle(now, self.idletimeout)
+            if entry.references <= 0 and not entry.idlevideo and not entry.idleaudio:
+                del self._entries[path]
+                entry.close()
+
+    def clear(self):
+        with self._lock:
+            for entry in self._entries.values():
+                entry.close()
+            self._entries = {}
+
+
+mediapool = MediaPool()
@@ -1,3 +1,4 @@
+import ctypes
 from ctypes import c_void_p
 
 import numpy as np
@@ -7,13 +8,21 @@ from scipy.spatial.transform import Rotation
 from czeditor.customShaderCompilation import compileProgram, compileShader
 
 
-# Copy a pointer to a bound opengl GL_PIXEL_UNPACK_BUFFER
-def CopyToBuffer(pointer: int, maxlen: int):
-    glBufferData(GL_PIXEL_UNPACK_BUFFER, maxlen, None, GL_STREAM_DRAW)
-    data = glMapBuffer(GL_PIXEL_UNPACK_BUFFER, GL_WRITE_ONLY)
-    array = (GLubyte*maxlen).from_address(data)
-    ctypes.memmove(array, pointer, maxlen)
-    glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+# Texture uploads of the frame being drawn, the viewport resets it for every frame
+uploadstats = {"bytes": 0, "uploads": 0, "skipped": 0}
+
+
+def ResetUploadStats():
+    uploadstats.update(bytes=0, uploads=0, skipped=0)
+
+
+def CountUpload(nbytes: int):
+    uploadstats["bytes"] += nbytes
+    uploadstats["uploads"] += 1
+
+
+def CountSkippedUpload():
+    uploadstats["skipped"] += 1
 
 
 # Create a bound RGBA texture with glTexImage2D and a pointer to image data
@@ -29,17 +38,129 @@ def CreateTexture(pointer: int, size: tuple):
     glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA,
                  size[0], size[1], 0, GL_RGBA, GL_UNSIGNED_BYTE, c_void_p(pointer))
 
-# CopyToBuffer but with a glTexSubImage2D appended.
+
+# Slots of a PixelUploadRing, a texture can be uploaded this many frames ahead of the GPU reading it
+UPLOAD_RING_DEPTH = 3
+
+
+# Several pixel unpack buffers used in turn for the uploads of one texture.
+# The GPU copies from a slot asynchronously while the next frame is written into another one,
+# a fence per slot tells when the GPU is done with it and the slot can be written again.
+# Buffers are persistently mapped when the driver has glBufferStorage, otherwise mapped unsynchronized for every upload.
+class PixelUploadRing:
+    def __init__(self, depth=UPLOAD_RING_DEPTH):
+        self.depth = depth
+        self.persistent = bool(glBufferStorage)
+        self.buffers = []
+        self.fences = []
+        self.pointers = []
+        self.nbytes = 0
+        self.slot = 0
+
+    def _allocate(self, nbytes: int):
+        self.delete()
+        self.buffers = [int(buffer)
+                        for buffer in np.atleast_1d(glGenBuffers(self.depth))]
+        self.fences = [None]*self.depth
+        self.pointers = [None]*self.depth
+        for i, buffer in enumerate(self.buffers):
+            glBindBuffer(GL_PIXEL_UNPACK_BUFFER, buffer)
+            if (self.persistent):
+                flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+                glBufferStorage(GL_PIXEL_UNPACK_BUFFER, nbytes, None, flags)
+                self.pointers[i] = glMapBufferRange(
+                    GL_PIXEL_UNPACK_BUFFER, 0, nbytes, flags)
+            else:
+                glBufferData(GL_PIXEL_UNPACK_BUFFER,
+                             nbytes, None, GL_STREAM_DRAW)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        self.nbytes = nbytes
+        self.slot = 0
+
+    # Blocks until the GPU finished reading the slot, which only happens if it is depth frames behind
+    def _wait(self, slot: int):
+        fence = self.fences[slot]
+        if (fence is None):
+            return
+        while (glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, 1000000) == GL_TIMEOUT_EXPIRED):
+            pass
+        glDeleteSync(fence)
+        self.fences[slot] = None
+
+    # Mapped memory of the next free slot as an array of the given shape, write only.
+    # Whatever is written into it is uploaded to the bound texture by submit.
+    def acquire(self, shape: tuple) -> np.ndarray:
+        nbytes = int(np.prod(shape))
+        if (nbytes != self.nbytes):
+            self._allocate(nbytes)
+        slot = self.slot
+        self._wait(slot)
+        if (self.persistent):
+            pointer = self.pointers[slot]
+        else:
+            glBindBuffer(GL_PIXEL_UNPACK_BUFFER, self.buffers[slot])
+            pointer = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, nbytes,
+                                       GL_MAP_WRITE_BIT | GL_MAP_UNSYNCHRONIZED_BIT | GL_MAP_INVALIDATE_RANGE_BIT)
+            glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        return np.ctypeslib.as_array((GLubyte*nbytes).from_address(pointer)).reshape(shape)
+
+    # Uploads the slot given out by acquire to the bound texture
+    def submit(self, size: tuple):
+        slot = self.slot
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, self.buffers[slot])
+        if (not self.persistent):
+            glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0,
+                        size[0], size[1], GL_RGBA, GL_UNSIGNED_BYTE, c_void_p(0))
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        self.fences[slot] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.slot = (slot+1) % self.depth
+
+    # Copies nbytes at pointer into the next free slot and uploads it to the bound texture
+    def upload(self, pointer: int, nbytes: int, size: tuple):
+        ctypes.memmove(self.acquire((nbytes,)).ctypes.data, pointer, nbytes)
+        self.submit(size)
+
+    def delete(self):
+        for slot, buffer in enumerate(self.buffers):
+            self._wait(slot)
+            if (self.persistent):
+                glBindBuffer(GL_PIXEL_UNPACK_BUFFER, buffer)
+                glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        if (self.buffers):
+            glDeleteBuffers(len(self.buffers), self.buffers)
+        self.buffers = []
+        self.fences = []
+        self.pointers = []
+        self.nbytes = 0
+
+
+# Sets float uniforms of a program in use from a dict, sequences of 2 to 4 numbers become vectors
+def SetUniforms(program, uniforms: dict):
+    for name, value in uniforms.items():
+        location = glGetUniformLocation(program, name)
+        if isinstance(value, (int, float)):
+            glUniform1f(location, value)
+        else:
+            [glUniform2f, glUniform3f, glUniform4f][len(value)-2](
+                location, *value)
 
 
-def UpdateTextureWithBuffer(pointer: int, maxlen: int, size: tuple):
-    glBufferData(GL_PIXEL_UNPACK_BUFFER, maxlen, None, GL_STREAM_DRAW)
-    data = glMapBuffer(GL_PIXEL_UNPACK_BUFFER, GL_WRITE_ONLY)
-    array = (GLubyte*maxlen).from_address(data)
-    ctypes.memmove(array, pointer, maxlen)
-    glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
-    glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0,
-                    size[0], size[1], GL_RGBA, GL_UNSIGNED_BYTE, c_void_p(0))
+# Size in pixels of the screen space bounding box of vertices (rows of x,y,z,u,v), None if they are behind the camera
+def ProjectedSize(vertices, projection, viewport=(1280, 720)):
+    if (len(vertices) == 0):
+        return None
+    points = np.hstack((vertices[:, :3], np.ones((len(vertices), 1))))
+    # QMatrix4x4.data() is column major, so this is the transposed matrix
+    clip = points @ np.array(projection.data(),
+                             dtype=np.float64).reshape(4, 4)
+    if (np.any(clip[:, 3] <= 0)):
+        return None
+    ndc = clip[:, :2]/clip[:, 3:4]
+    size = (ndc.max(axis=0)-ndc.min(axis=0))/2*viewport
+    return (max(1, int(np.ceil(size[0]))), max(1, int(np.ceil(size[1]))))
 
 
 def RotatePoints(points, X, Y, Z):
@@ -56,7 +177,9 @@ def RotatePoints(points, X, Y, Z):
     )
 
 
-def GenerateShader(shader, isframebuffer=False):
+# source is the compiled fragment shader of a procedural source, defining vec4 sourceColor(vec2 pos).
+# When given the layer is colored by it instead of sampling the image texture.
+def GenerateShader(shader, isframebuffer=False, source=None):
     vertexshaderlist = []
     if (not isframebuffer):
         vertexDeclarations = "\n"
@@ -125,6 +248,8 @@ uniform int height;
 uniform float spectrum[512];
 out vec4 color;
 """
+    if (source is not None):
+        mainfragmentcode += "vec4 sourceColor(vec2 pos);\n"
     addedDeclarations = []
     for snippet in shader:
         if ("fragmentshader" in snippet and snippet["fragmentdeclaration"] not in addedDeclarations):
@@ -154,7 +279,10 @@ out vec4 color;
                     "$inpos", curInPosName).replace("$outpos", curOutPosName)+"\n    "
             curInPosName, curOutPosName = curOutPosName, curInPosName  # Swap them
     else:  # for DOES have an else, it executes if the loop DIDN'T break.
-        mainfragmentcode += f"color = texture(image,{curInPosName});\n}}"
+        if (source is not None):
+            mainfragmentcode += f"color = sourceColor({curInPosName});\n}}"
+        else:
+            mainfragmentcode += f"color = texture(image,{curInPosName});\n}}"
 
     mainvertexshader = compileShader(mainvertexcode, GL_VERTEX_SHADER)
     mainfragmentshader = compileShader(mainfragmentcode, GL_FRAGMENT_SHADER)
@@ -164,5 +292,7 @@ out vec4 color;
         ] +\
         fragmentshaderlist +\
         [mainfragmentshader]
+    if (source is not None):
+        shaders.append(source)
 
     return shaders, (mainvertexshader, mainfragmentshader)
@@ -0,0 +1,190 @@
+import os
+import traceback
+
+import av
+import numpy as np
+from PySide6.QtCore import QFileInfo
+
+from czeditor.util.cachehelper import fileKey, getCacheDirectory
+from czeditor.util.filecache import CACHE_READY, BackgroundFileCache
+
+PCM_CHANNELS = 2
+# Samples summarized by one entry of the finest peak level
+PEAK_BLOCK_SIZE = 256
+
+
+
+# Min, max and RMS of the audio over blocks of samples, each level summarizing twice as many samples as the one before.
+# Drawing a waveform only touches about one entry per pixel at any zoom.
+class WaveformPeaks:
+    def __init__(self, levels: list, samplerate: int, blocksize: int = PEAK_BLOCK_SIZE):
+        # Each level is a (3, blocks) array of min, max and rms
+        self.levels = levels
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+
+    @staticmethod
+    def compute(pcm: np.ndarray, samplerate: int, blocksize: int = PEAK_BLOCK_SIZE, chunkblocks: int = 4096):
+        blocks = len(pcm)//blocksize
+        finest = np.zeros((3, blocks), dtype=np.float32)
+        # In chunks, so a long file is never loaded from the memory map at once
+        for start in range(0, blocks, chunkblocks):
+            end = min(blocks, start+chunkblocks)
+            mono = pcm[start*blocksize:end*blocksize].reshape(
+                end-start, blocksize, -1).mean(axis=2)
+            finest[0, start:end] = mono.min(axis=1)
+            finest[1, start:end] = mono.max(axis=1)
+            finest[2, start:end] = np.sqrt(np.square(mono).mean(axis=1))
+        levels = [finest]
+        while levels[-1].shape[1] > 1:
+            previous = levels[-1][:, :levels[-1].shape[1]//2*2]
+            pairs = previous.reshape(3, -1, 2)
+            levels.append(np.stack((pairs[0].min(axis=1), pairs[1].max(
+                axis=1), np.sqrt(np.square(pairs[2]).mean(axis=1)))))
+        return WaveformPeaks(levels, samplerate, blocksize)
+
+    @staticmethod
+    def load(path: str, samplerate: int):
+        with np.load(path) as data:
+            return WaveformPeaks([data[f"level{i}"] for i in range(int(data["levels"]))], samplerate, int(data["blocksize"]))
+
+    def save(self, path: str):
+        with open(path, "wb") as file:
+            np.savez(file, levels=len(self.levels), blocksize=self.blocksize,
+                     **{f"level{i}": level for i, level in enumerate(self.levels)})
+
+    # Min, max and rms for columns equal parts of [startsample, endsample), as a (3, columns) array
+    def query(self, startsample: int, endsample: int, columns: int) -> np.ndarray:
+        samplespercolumn = max(1, (endsample-startsample)/columns)
+        level = min(len(self.levels)-1, max(0,
+                    int(np.log2(max(1, samplespercolumn/self.blocksize)))))
+        peaks = self.levels[level]
+        blocksize = self.blocksize*2**level
+        result = np.zeros((3, columns), dtype=np.float32)
+        edges = ((startsample+np.arange(columns+1)*samplespercolumn) //
+                 blocksize).astype(np.int64)
+        # Columns before or after the audio stay silent
+        valid = np.flatnonzero((edges[:-1] >= 0) & (edges[:-1] < peaks.shape[1]))
+        edges = np.clip(edges, 0, peaks.shape[1])
+        if (len(valid) == 0):
+            return result
+        starts = edges[valid]
+        # Columns narrower than a block still show the block they are in
+        ends = np.maximum(edges[valid+1], starts+1)
+        peaks = peaks[:, :ends[-1]]
+        result[0, valid] = np.minimum.reduceat(peaks[0], starts)
+        result[1, valid] = np.maximum.reduceat(peaks[1], starts)
+        counts = np.maximum(np.append(starts[1:], ends[-1])-starts, 1)
+        result[2, valid] = np.sqrt(np.add.reduceat(
+            np.square(peaks[2]), starts)/counts)
+        return result
+
+
+# Audio of media files decoded once into raw float32 files in the user cache.
+# The files are memory mapped, so reading anywhere in them is a slice instead of a decoder seek.
+class PCMCacheManager(BackgroundFileCache):
+    def __init__(self):
+        super().__init__()
+        self._maps = {}
+        # Peaks by the path of the PCM file they are computed from, None while computing
+        self._peaks = {}
+
+    def pcmpath(self, filename: str, samplerate: int) -> str:
+        return os.path.join(getCacheDirectory("pcm"), f"{fileKey(filename)}_{samplerate}.f32")
+
+    # Peaks are stored next to the PCM file they were computed from
+    def peakspath(self, pcmpath: str) -> str:
+        return os.path.splitext(pcmpath)[0]+".peaks.npz"
+
+    # Starts decoding in the background if the cache file does not exist yet
+    def request(self, filename: str, samplerate: int) -> str:
+        return super().request(self.pcmpath(filename, samplerate), _decode,
+                               QFileInfo(filename).canonicalFilePath(), samplerate)
+
+    # Returns the decoded samples as a (samples, channels) memory map if they are ready
+    def get(self, filename: str, samplerate: int):
+        path = self.pcmpath(filename, samplerate)
+        if (self.request(filename, samplerate) != CACHE_READY):
+            return None
+        return self._map(path)
+
+    def _map(self, path: str) -> np.ndarray:
+        with self._lock:
+            if path not in self._maps:
+                if (os.path.getsize(path) == 0):  # No audio stream
+                    self._maps[path] = np.zeros(
+                        (0, PCM_CHANNELS), dtype=np.float32)
+                else:
+                    self._maps[path] = np.memmap(
+                        path, dtype=np.float32, mode="r").reshape(-1, PCM_CHANNELS)
+            return self._maps[path]
+
+    # Returns the waveform peaks once the audio is decoded, computing them in the background if needed
+    def peaks(self, filename: str, samplerate: int):
+        path = self.pcmpath(filename, samplerate)
+        if (self.request(filename, samplerate) != CACHE_READY):
+            return None
+        with self._lock:
+            if path in self._peaks:
+                return self._peaks[path]
+        peakspath = self.peakspath(path)
+        if (not os.path.exists(peakspath)):
+            with self._lock:
+                self._peaks[path] = None
+            self._executor.submit(self._computePeaks, path, samplerate)
+            return None
+        peaks = WaveformPeaks.load(peakspath, samplerate)
+        with self._lock:
+            self._peaks[path] = peaks
+        return peaks
+
+    # Peaks are computed right after decoding, None marks them as pending
+    def generated(self, path: str, filename: str, samplerate: int):
+        with self._lock:
+            self._peaks[path] = None
+        self._executor.submit(self._computePeaks, path, samplerate)
+
+    def _computePeaks(self, path: str, samplerate: int):
+        try:
+            peaks = WaveformPeaks.compute(self._map(path), samplerate)
+            peakspath = self.peakspath(path)
+            peaks.save(peakspath+".tmp")
+            os.replace(peakspath+".tmp", peakspath)
+        except Exception:
+            traceback.print_exc()
+            return
+        with self._lock:
+            self._peaks[path] = peaks
+        self._changed.set()
+
+
+def _decode(outputpath: str, path: str, samplerate: int):
+    decodepcm(path, outputpath, samplerate)
+
+
+def decodepcm(path: str, outputpath: str, samplerate: int):
+    with av.open(path) as container, open(outputpath, "wb") as output:
+        if (not container.streams.audio):
+            return
+        stream = container.streams.audio[0]
+        stream.thread_type = "AUTO"
+        resampler = av.AudioResampler(
+            format="flt", layout="stereo", rate=samplerate)
+        for decodedFrame in container.decode(stream):
+            for resampledFrame in resampler.resample(decodedFrame):
+                output.write(resampledFrame.to_ndarray().tobytes())
+        for resampledFrame in resampler.resample(None):
+            output.write(resampledFrame.to_ndarray().tobytes())
+
+
+# Copies count samples starting at sample, with silence outside the decoded audio
+def readsamples(pcm: np.ndarray, sample: int, count: int) -> np.ndarray:
+    out = np.zeros((count, PCM_CHANNELS), dtype=np.float32)
+    first = max(sample, 0)
+    last = min(sample+count, len(pcm))
+    if (last > first):
+        out[first-sample:last-sample] = pcm[first:last]
+    return out
+
+
+pcmcache = PCMCacheManager()
@@ -0,0 +1,68 @@
+import os
+
+import av
+from PySide6.QtCore import QFileInfo
+
+from czeditor.util.cachehelper import fileKey, getCacheDirectory
+from czeditor.util.filecache import (CACHE_FAILED, CACHE_NONE, CACHE_PENDING,
+                                     CACHE_READY, BackgroundFileCache)
+
+# Proxies are scaled to this height, keeping the aspect ratio
+PROXY_HEIGHT = 360
+
+PROXY_NONE = CACHE_NONE
+PROXY_GENERATING = CACHE_PENDING
+PROXY_READY = CACHE_READY
+PROXY_FAILED = CACHE_FAILED
+
+
+# Low resolution, intra only copies of videos used for interactive preview.
+# Every frame of an MJPEG file is a keyframe, so seeking anywhere costs a single decode.
+class ProxyManager(BackgroundFileCache):
+    def proxypath(self, filename: str) -> str:
+        return os.path.join(getCacheDirectory("proxies"), fileKey(filename)+".mkv")
+
+    def state(self, filename: str) -> str:
+        return super().state(self.proxypath(filename))
+
+    # Starts generating the proxy in the background if it does not exist yet
+    def request(self, filename: str) -> str:
+        return super().request(self.proxypath(filename), _transcode, QFileInfo(filename).canonicalFilePath())
+
+    # Returns the path of the proxy if it is ready to be used
+    def get(self, filename: str):
+        if (self.request(filename) == PROXY_READY):
+            return self.proxypath(filename)
+        return None
+
+
+def _transcode(outputpath: str, path: str):
+    transcodeproxy(path, outputpath)
+
+
+def transcodeproxy(path: str, outputpath: str):
+    with av.open(path) as inputcontainer, av.open(outputpath, "w", format="matroska") as outputcontainer:
+        inputstream = inputcontainer.streams.video[0]
+        inputstream.thread_type = "AUTO"
+        height = min(PROXY_HEIGHT, inputstream.codec_context.height)
+        width = round(inputstream.codec_context.width /
+                      inputstream.codec_context.height*height/2)*2
+        height = height//2*2
+        outputstream = outputcontainer.add_stream(
+            "mjpeg", rate=inputstream.average_rate)
+        outputstream.width = width
+        outputstream.height = height
+        outputstream.pix_fmt = "yuvj420p"
+        # Keep the original timestamps so frame numbers match between the proxy and the original
+        outputstream.codec_context.time_base = inputstream.time_base
+        for frame in inputcontainer.decode(inputstream):
+            scaled = frame.reformat(width, height, "yuvj420p")
+            scaled.pts = frame.pts
+            scaled.time_base = inputstream.time_base
+            for packet in outputstream.encode(scaled):
+                outputcontainer.mux(packet)
+        for packet in outputstream.encode():
+            outputcontainer.mux(packet)
+
+
+proxymanager = ProxyManager()
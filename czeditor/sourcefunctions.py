@@ -1,24 +1,60 @@
+import concurrent.futures
 import os
 
 import numpy as np
 import pyspng
-import sounddevice
-from moviepy.audio.io.AudioFileClip import AudioFileClip
 from PIL import Image
 from PySide6.QtCore import QFileInfo
 
-from czeditor.avreader import PyAVSeekableVideoReader
-from czeditor.generate import CreateXPWindow
+from czeditor.avreader import videoframecache
+from czeditor.capture import AudioCapture, recordingpath, takepath
+from czeditor.generate import CreateXPWindow, gradient
 from czeditor.graphics import *
+from czeditor.imagesequence import PACK_OPTIONS, sequenceloader
+from czeditor.mediapool import mediapool
+from czeditor.pcmcache import pcmcache, readsamples
+from czeditor.proxies import PROXY_GENERATING, PROXY_NONE, PROXY_READY, proxymanager
 from czeditor.properties import *
+from czeditor.sourcejobs import sourcejobs
 from czeditor.timelineitems import *
 from czeditor.util import *
+from czeditor.util.lrucache import cacheservice
 
-loadedimages = {}
+loadedimages = cacheservice.namespace("images")
 emptyimage = Image.new("RGBA", (1, 1), (0, 0, 0, 0))
 
 sourcefunctionsdropdown = []
 
+# Fragment shaders of procedural sources. They define sourceColor, which is transparent outside the layer like the image texture's border.
+FILLED_RECTANGLE_SHADER = """#version 450 core
+uniform vec4 fillcolor;
+vec4 sourceColor(vec2 pos)
+{
+    if (any(lessThan(pos, vec2(0))) || any(greaterThan(pos, vec2(1)))) return vec4(0);
+    return fillcolor;
+}"""
+
+GRADIENT_SHADER = """#version 450 core
+uniform vec4 colora;
+uniform vec4 colorb;
+vec4 sourceColor(vec2 pos)
+{
+    if (any(lessThan(pos, vec2(0))) || any(greaterThan(pos, vec2(1)))) return vec4(0);
+    return mix(colora, colorb, pos.x);
+}"""
+
+NOISE_SHADER = """#version 450 core
+uniform float frame;
+uniform float seed;
+uniform vec2 size;
+vec4 sourceColor(vec2 pos)
+{
+    if (any(lessThan(pos, vec2(0))) || any(greaterThan(pos, vec2(1)))) return vec4(0);
+    vec2 pixel = floor(pos*size);
+    float value = fract(sin(dot(pixel+vec2(seed, frame), vec2(12.9898, 78.233)))*43758.5453);
+    return vec4(vec3(value), 1);
+}"""
+
 class Source:
     def __init_subclass__(cls) -> None:
         sourcefunctionsdropdown.append([cls.name, cls])
@@ -32,11 +68,15 @@ class NormalImage(Source):
         }
     )
 
+    # Decoding a large image takes long, until it is loaded this returns the future of the job loading it
     def image(param: Params, parentclass, frame):
         path = param.imagepath()
-        if (path in loadedimages):
-            img = loadedimages[path]
+        img = loadedimages.get(path)
+        if (img is not None):
             return img
+        return sourcejobs.submit(("image", path), NormalImage.load, path)
+
+    def load(path):
         try:
             if (os.path.splitext(path)[1] == ".png"):
                 with open(path, "rb") as file:
@@ -44,14 +84,32 @@ class NormalImage(Source):
             else:
                 img = np.array(Image.open(
                     QFileInfo(path).canonicalFilePath()).convert("RGBA"))
-            loadedimages[path] = img
-            if (len(loadedimages.keys()) > 300):
-                del loadedimages[loadedimages.keys()[0]]
-
-            return img
+            # Dropped when the file is saved again
+            return loadedimages.put(path, img, path)
         except:
             return np.array([[[0, 0, 0, 0]]])
 
+    # Returns the smallest level of the image's pyramid that still covers size, each level being half the size of the one before
+    def previewimage(param: Params, parentclass, frame, size):
+        img = NormalImage.image(param, parentclass, frame)
+        if (isinstance(img, concurrent.futures.Future)):
+            return img
+        level = coveringlevel((img.shape[1], img.shape[0]), size)
+        path = param.imagepath()
+        for i in range(1, level+1):
+            # Levels are built from the one above them once and cached like the image itself
+            previous = img
+            img = loadedimages.getorcreate(
+                (path, i), lambda: np.array(Image.fromarray(previous).reduce(2)), path)
+        return img
+
+    # Full resolution of the image, previews can be smaller
+    def resolution(param: Params):
+        img = loadedimages.get(param.imagepath())
+        if (img is None):
+            return None
+        return (img.shape[1], img.shape[0])
+
     def __str__(self):
         return self.name
 
@@ -75,6 +133,63 @@ class FilledRectangle(Source):
                        np.array(param.color, dtype=np.uint8))
         return made
 
+    # Drawn on the GPU, image is only used where a pixel buffer is really needed
+    def procedural(param: Params, parentclass, frame):
+        return {"code": FILLED_RECTANGLE_SHADER,
+                "uniforms": {"fillcolor": [channel/255 for channel in param.color]},
+                "width": param.width(), "height": param.height()}
+
+    def __str__(self):
+        return self.name
+
+
+class Gradient(Source):
+    name = "Gradient"
+    params = Params(
+        {
+            "width": IntProperty(256),
+            "height": IntProperty(256),
+            "colora": [0, 0, 128, 255],
+            "colorb": [16, 132, 208, 255]
+        }
+    )
+
+    def image(param: Params, parentclass, frame):
+        return np.array(gradient(param.width(), param.height(), param.colora, param.colorb))
+
+    def procedural(param: Params, parentclass, frame):
+        return {"code": GRADIENT_SHADER,
+                "uniforms": {"colora": [channel/255 for channel in param.colora],
+                             "colorb": [channel/255 for channel in param.colorb]},
+                "width": param.width(), "height": param.height()}
+
+    def __str__(self):
+        return self.name
+
+
+class Noise(Source):
+    name = "Noise"
+    params = Params(
+        {
+            "width": IntProperty(256),
+            "height": IntProperty(256),
+            "seed": IntProperty(0)
+        }
+    )
+
+    def image(param: Params, parentclass, frame):
+        rng = np.random.default_rng((param.seed(), int(frame)))
+        made = np.full((param.height(), param.width(), 4), 255, dtype=np.uint8)
+        made[:, :, :3] = rng.integers(
+            0, 256, (param.height(), param.width(), 1), dtype=np.uint8)
+        return made
+
+    # A new pattern every frame
+    def procedural(param: Params, parentclass, frame):
+        return {"code": NOISE_SHADER,
+                "uniforms": {"seed": float(param.seed()), "size": (float(param.width()), float(param.height()))},
+                "width": param.width(), "height": param.height()}
+
     def __str__(self):
         return self.name
 
@@ -104,8 +219,13 @@ class XPError(Source):
         # fillindefaults(param,{"text":"","title":"","buttons":[],"buttonstyles":emptylist(0),"erroricon":Selectable(1,[["Critical Error","xp/Critical Error.png"],["Exclamation","xp/Exclamation.png"],["Information","xp/Information.png"],["Question","xp/Question.png"],["None",""]])})
         transient = param.transient()
         if (transient.lastParams != str(param)):
-            transient.cached = np.array(CreateXPWindow(param))
+            # Generated on a worker from a snapshot, the parameters can change while it runs
+            snapshot = param.copy()
+            transient.cached = sourcejobs.submit(
+                ("xp", str(param)), lambda: np.array(CreateXPWindow(snapshot)))
             transient.lastParams = str(param)
+        if (isinstance(transient.cached, concurrent.futures.Future) and transient.cached.done()):
+            transient.cached = transient.cached.result()
         return transient.cached
 
     def __str__(self):
@@ -127,13 +247,17 @@ class XPError(Source):
 class ImageSequence(Source):
     name = "Image Sequence"
     params = Params({
-        "imagespath": FileProperty("")
+        "imagespath": FileProperty(""),
+        # Decodes the sequence once into a single file that plays back without PNG decoding
+        "framecache": SelectableProperty(PACK_OPTIONS)
     })
 
     def image(param: Params, parentclass, frame):
         # return Image.open(param.imagespath.replace("*",str(int(parentclass.playbackframe))))
-        with open(param.imagespath().replace("*", str(int(frame))), "rb") as file:
-            img = pyspng.load(file.read())
+        loader = sequenceloader(param.imagespath(), param.framecache())
+        img = loader.get(int(frame))
+        if (img is None):
+            return np.array([[[0, 0, 0, 0]]])
         return img
 
     def __str__(self):
@@ -147,8 +271,13 @@ class Video(Source):
         "startframe": IntProperty(0),
         "duration": IntProperty(0),
         "transient": TransientProperty(Params({
+            "lease": None,
+            "opening": None,
+            "openedimage": None,
+            "proxylease": None,
+            "proxystate": PROXY_NONE,
             "pyavobject": None,
-            "moviepyobject": None,
+            "audioreader": None,
             "decodedaudio": None,
             "maxduration": 0,
             "entirevideo": None,
@@ -159,89 +288,177 @@ class Video(Source):
     Return the current frame the cursor is on in a video file
     """
 
+    # Leases the decoders of the current file from the media pool when the path changed.
+    # Opening a file takes long, so it happens on a worker. Returns whether the file is open yet, wait blocks until it is.
+    def open(param: Params, wait=False) -> bool:
+        transient = param.transient()
+        path = param.videopath()
+        if (path != transient.lastpath):
+            Video.close(param)
+            transient.lastpath = path
+            transient.opening = sourcejobs.submit(
+                ("video", id(transient), path), Video.lease, path)
+        opening = transient.opening
+        if (opening is not None and (wait or opening.done())):
+            transient.opening = None
+            Video.opened(param, opening.result())
+        return transient.lease is not None
+
+    # Runs on a worker, also opens the audio container so nothing is left to open on the paint thread
+    def lease(path):
+        lease = mediapool.lease(path)
+        lease.audio
+        return lease
+
+    def opened(param: Params, lease):
+        transient = param.transient()
+        transient.openedimage = None
+        transient.lease = lease
+        transient.pyavobject = lease.video
+        transient.audioreader = lease.audio
+        transient.decodedaudio = pcmcache.get(
+            param.videopath(), transient.audioreader.samplerate)
+        transient.proxystate = proxymanager.request(param.videopath())
+        param.duration.set(
+            int(transient.pyavobject.duration*60)-param.startframe())
+        transient.maxduration = int(transient.pyavobject.duration*60)
+
+    # Resolves once the file is open, so the compositor keeps the last image until then and draws again after
+    def whenopened(param: Params) -> concurrent.futures.Future:
+        transient = param.transient()
+        if (transient.openedimage is None):
+            transient.openedimage = concurrent.futures.Future()
+            transient.opening.add_done_callback(
+                lambda done, future=transient.openedimage: future.set_result(np.array(emptyimage)))
+        return transient.openedimage
+
+    # Gives the decoders of the previous file back to the media pool
+    def close(param: Params):
+        transient = param.transient()
+        if (transient.lease is not None):
+            transient.lease.release()
+        if (transient.proxylease is not None):
+            transient.proxylease.release()
+        transient.lease = None
+        transient.proxylease = None
+        transient.proxystate = PROXY_NONE
+        transient.opening = None
+        transient.openedimage = None
+        transient.pyavobject = None
+        transient.audioreader = None
+        transient.decodedaudio = None
+        transient.maxduration = 0
+
     def image(param: Params, parentclass, frame):
+        return Video.previewimage(param, parentclass, frame, None)
+
+    # Decodes at the smallest power of two scale that still covers size, or at full resolution if size is None
+    def previewimage(param: Params, parentclass, frame, size):
         # return Image.open(param.imagespath.replace("*",str(int(parentclass.playbackframe))))
+        decoding = Video.decodeframe(param, parentclass, frame, size)
+        if (decoding is None and param.transient().opening is not None):
+            return Video.whenopened(param)
+        if (decoding is None):
+            return np.array(emptyimage)
+        reader, frame, level = decoding
+        img = videoframecache.get((reader.path, frame, level))
+        if img is None:
+            img = reader.read(frame, level)
+        return img
+
+    # The reader, video frame and scale level to show, None when there is no video at that time.
+    # The compositor uses it to decode the frame right into its upload buffer with reader.readinto.
+    def decodeframe(param: Params, parentclass, frame, size):
         transient = param.transient()
         if (not os.path.exists(param.videopath())):
             param.duration.set(0)
-            return np.array(emptyimage)
-        if (param.videopath() != transient.lastpath or transient.pyavobject == None):
-            if (transient.pyavobject != None):
-                transient.pyavobject.close()
-                transient.moviepyobject.close()
-
-            # transient.pyavobject = PyAVReaderTimed(param.videopath(),cache_size=32)
-            transient.pyavobject = PyAVSeekableVideoReader(
-                param.videopath())
-            transient.moviepyobject = AudioFileClip(
-                param.videopath(), nbytes=2, fps=48000)
-            transient.lastpath = param.videopath()
-            param.duration.set(int(
-                len(transient.pyavobject)/transient.pyavobject.frame_rate*60)-param.startframe())
-            transient.maxduration = int(
-                len(transient.pyavobject)/transient.pyavobject.frame_rate*60)
-            print(transient.maxduration)
+            return None
+        # Nothing is shown while the file opens, except when exporting where every frame counts
+        if (not Video.open(param, parentclass.exporting)):
+            return None
         # Add the beginning frame offset
         frame += param.startframe()
 
-        # Correct the framerate from 60 fps to video fps
-        frame = int(frame/60*transient.pyavobject.frame_rate)
-        if (frame >= len(transient.pyavobject) or frame < 0):  # Check if its after or before
-            return np.array(emptyimage)
-        img = transient.pyavobject[int(frame)]
-        return img
+        if (frame >= transient.maxduration or frame < 0):  # Check if its after or before
+            return None
+        reader = Video.previewreader(param, parentclass)
+        # Find the video frame shown at this time, frames are not evenly spaced in variable frame rate video
+        frame = reader.frameAt(frame/60)
+        transient.pyavobject.setPlaying(
+            parentclass.isplaying and reader is transient.pyavobject)
+        if (transient.proxylease is not None):
+            transient.proxylease.video.setPlaying(
+                parentclass.isplaying and reader is transient.proxylease.video)
+        level = 0 if size is None else coveringlevel(reader.resolution, size)
+        return reader, frame, level
+
+    # The proxy while editing once it has been generated, the original file when exporting
+    def previewreader(param: Params, parentclass):
+        if (parentclass.exporting):
+            return param.transient().pyavobject
+        return Video.proxyreader(param) or param.transient().pyavobject
+
+    # The reader of the proxy, None until it has been generated
+    def proxyreader(param: Params):
+        transient = param.transient()
+        if (transient.proxystate == PROXY_GENERATING):
+            transient.proxystate = proxymanager.state(param.videopath())
+        if (transient.proxystate != PROXY_READY):
+            return None
+        if (transient.proxylease is None):
+            transient.proxylease = mediapool.lease(
+                proxymanager.proxypath(param.videopath()))
+        return transient.proxylease.video
+
+    # Resolution of the original file, the displayed image can be a smaller proxy
+    def resolution(param: Params):
+        if (param.transient().pyavobject is None):
+            return None
+        return param.transient().pyavobject.resolution
 
     def sound(param: Params, sample):
         transient = param.transient()
         if (not os.path.exists(param.videopath())):
             return np.array((0)), 1
-        if (param.videopath() != transient.lastpath or transient.moviepyobject == None):
-            if (transient.moviepyobject != None):
-                transient.pyavobject.close()
-                transient.moviepyobject.close()
-
-            transient.pyavobject = PyAVSeekableVideoReader(
-                param.videopath())
-            transient.moviepyobject = AudioFileClip(
-                param.videopath(), nbytes=2, fps=48000)
-            transient.lastpath = param.videopath()
-            param.duration.set(int(
-                len(transient.pyavobject)/transient.pyavobject.frame_rate*60)-param.startframe())
-            transient.maxduration = int(
-                len(transient.pyavobject)/transient.pyavobject.frame_rate*60)
-
-        sample += int(param.startframe()/60*transient.moviepyobject.fps)
-        if transient.moviepyobject.reader.pos != sample:
-            transient.moviepyobject.reader.seek(sample)
-            transient.moviepyobject.reader.pos = sample
-        chunk = transient.moviepyobject.reader.read_chunk(512)
-        return chunk, transient.moviepyobject.fps
+        # Silent while the file opens, the audio callback must not wait for it
+        if (not Video.open(param)):
+            return np.array((0)), 1
+
+        samplerate = transient.audioreader.samplerate
+        sample += int(param.startframe()/60*samplerate)
+        if (transient.decodedaudio is None):
+            transient.decodedaudio = pcmcache.get(
+                param.videopath(), samplerate)
+        # Decoding into the cache takes a while, the decoder is used until it is done
+        if (transient.decodedaudio is not None):
+            return readsamples(transient.decodedaudio, sample, 512), samplerate
+        return transient.audioreader.read(sample, 512), samplerate
+
+    # Peaks of the audio for the timeline, None until they are computed
+    def waveform(param: Params):
+        if (param.transient().audioreader is None):
+            return None
+        return pcmcache.peaks(param.videopath(), param.transient().audioreader.samplerate)
 
     def timelineitem(param: Params, keyframe, windowClass):
-        return [TimelineDurationLineItem(param, windowClass, keyframe), TimelineDurationHandleItem(param, windowClass, keyframe), TimelineStartFrameHandleItem(param, windowClass, keyframe), TimelineVerticalLineItem(param, windowClass, keyframe)]
+        return [TimelineDurationLineItem(param, windowClass, keyframe), TimelineDurationHandleItem(param, windowClass, keyframe), TimelineStartFrameHandleItem(param, windowClass, keyframe), TimelineVerticalLineItem(param, windowClass, keyframe), TimelineProxyStateItem(param, windowClass, keyframe), TimelineThumbnailStripItem(param, windowClass, keyframe)]
 
     def seek(params: Params, frame):
+        if (not os.path.exists(params.videopath()) or not Video.open(params, True)):
+            return
         if (frame < params.transient().maxduration):
-            params.transient().pyavobject[int(
-                max(params.startframe(), frame)/60*params.transient().pyavobject.frame_rate)]
-            params.transient().moviepyobject.reader.seek(
-                int(max(params.startframe(), frame)/60*params.transient().moviepyobject.fps))
+            # Warms the reader previews are drawn from, the proxy once there is one
+            reader = Video.proxyreader(
+                params) or params.transient().pyavobject
+            reader[reader.frameAt(max(params.startframe(), frame)/60)]
+            if (params.transient().decodedaudio is None):
+                audioreader = params.transient().audioreader
+                audioreader.read(
+                    int(max(params.startframe(), frame)/60*audioreader.samplerate), 512)
 
     def initialize(param: Params):
-        transient = param.transient()
-        if (param.videopath() != transient.lastpath or transient.moviepyobject == None):
-            if (transient.moviepyobject != None):
-                transient.pyavobject.close()
-                transient.moviepyobject.close()
-            transient.pyavobject = PyAVSeekableVideoReader(
-                param.videopath())
-            transient.moviepyobject = AudioFileClip(
-                param.videopath(), nbytes=2, fps=48000)
-            transient.lastpath = param.videopath()
-            param.duration.set(int(
-                len(transient.pyavobject)/transient.pyavobject.frame_rate*60)-param.startframe())
-            transient.maxduration = int(
-                len(transient.pyavobject)/transient.pyavobject.frame_rate*60)
+        if (os.path.exists(param.videopath())):
+            Video.open(param)
         # print(chunk)
         # print(sample,secrets.moviepyobject.reader.pos,secrets.moviepyobject.reader.nframes)
 
@@ -268,20 +485,35 @@ class Video(Source):
 class Record(Source):
     name = "Record"
     params = Params({
+        # The take is saved here as it is recorded, into the user cache if empty
+        "recordingpath": FileProperty("", "Audio Files (*.flac *.wav)"),
         "transient": TransientProperty(Params({
-            "sounddevice": None
+            "capture": None,
+            "lastpath": None
         }
         ))
     })
 
+    # Reads what the input device captured since the last call, never waits for it.
+    # Recording starts with playback, every run of playback is a new take.
     def sound(param: Params, sample):
         transient = param.transient()
-        if transient.sounddevice is None:
-            transient.sounddevice = sounddevice.rec(512, 48000, 1)
-        sounddevice.wait()
-        samples = transient.sounddevice
-        transient.sounddevice = sounddevice.rec(512, 48000, 1)
-        return samples, 48000
+        if (transient.capture is not None and param.recordingpath() != transient.lastpath):
+            # Finish the take in the old file before writing to the new one
+            Record.stop(param)
+        if transient.capture is None:
+            # Earlier takes in the same file are kept, the new one gets a numbered name next to them
+            transient.capture = AudioCapture(
+                takepath(param.recordingpath()) if param.recordingpath() else recordingpath(), 48000, 1)
+            transient.lastpath = param.recordingpath()
+        return transient.capture.read(512), 48000
+
+    # Called when playback or rendering stops, closes the input device and finishes the file
+    def stop(param: Params):
+        transient = param.transient()
+        if transient.capture is not None:
+            transient.capture.close()
+            transient.capture = None
 
     def __str__(self):
         return self.name
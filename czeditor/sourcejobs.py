@@ -0,0 +1,29 @@
+import concurrent.futures
+import threading
+
+
+# Worker pool for slow source work. Sources return the future from submit() instead of an image,
+# the compositor keeps showing the layer's last image until it is done.
+class SourceJobs:
+    def __init__(self, workers=4):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    # Runs function(*args) on a worker, asking again for the same key while it runs returns the same future
+    def submit(self, key, function, *args) -> concurrent.futures.Future:
+        with self._lock:
+            future = self._jobs.get(key)
+            if (future is None):
+                future = self._executor.submit(function, *args)
+                self._jobs[key] = future
+                future.add_done_callback(lambda done: self._finished(key))
+            return future
+
+    def _finished(self, key):
+        with self._lock:
+            del self._jobs[key]
+
+
+sourcejobs = SourceJobs()
@@ -0,0 +1,79 @@
+import os
+import threading
+
+import av
+import numpy as np
+from PIL import Image
+from PySide6.QtCore import QFileInfo
+
+from czeditor.util.cachehelper import fileKey, getCacheDirectory
+from czeditor.util.filecache import CACHE_READY, BackgroundFileCache
+from czeditor.util.lrucache import cacheservice
+
+THUMBNAIL_HEIGHT = 48
+THUMBNAIL_MEMORY_BUDGET = 64*1024*1024
+
+
+# Small previews of video frames for the timeline, generated off the GUI thread and kept on disk.
+# frame is always in 60 fps timeline frames from the start of the file.
+class ThumbnailCache(BackgroundFileCache):
+    # Thumbnails on disk are still loaded into memory by a worker
+    readywhenexists = False
+
+    def __init__(self, workers=2):
+        super().__init__(workers)
+        self._memory = cacheservice.namespace(
+            "thumbnails", budget=THUMBNAIL_MEMORY_BUDGET)
+        self._local = threading.local()
+        self._keys = {}
+
+    def _filekey(self, path: str) -> str:
+        if (path not in self._keys):
+            self._keys[path] = fileKey(path)
+        return self._keys[path]
+
+    # Returns the thumbnail if it is ready, otherwise queues it and returns None
+    def get(self, filename: str, frame: int):
+        path = QFileInfo(filename).canonicalFilePath()
+        cachepath = os.path.join(getCacheDirectory(
+            "thumbnails", self._filekey(path)), str(frame)+".png")
+        thumbnail = self._memory.get(cachepath)
+        if (thumbnail is not None):
+            return thumbnail
+        if (self.request(cachepath, self._generate, path, frame) == CACHE_READY):
+            # Loaded before but dropped from memory since, the worker loads it again
+            self.forget(cachepath)
+            self.request(cachepath, self._generate, path, frame)
+        return None
+
+    # A thumbnail that does not decode is deleted and generated again by the next request
+    def generated(self, cachepath: str, path: str, frame: int):
+        self._memory.put(cachepath, np.array(
+            Image.open(cachepath).convert("RGBA")))
+
+    def _generate(self, outputpath: str, path: str, frame: int):
+        Image.fromarray(self._thumbnail(path, frame)).save(
+            outputpath, format="png")
+
+    # Each worker thread keeps its own containers open
+    def _container(self, path: str):
+        containers = getattr(self._local, "containers", None)
+        if (containers is None):
+            containers = self._local.containers = {}
+        if (path not in containers):
+            containers[path] = av.open(path)
+            containers[path].streams.video[0].thread_type = "AUTO"
+        return containers[path]
+
+    # Uses the keyframe at or before the frame, exact enough for a thumbnail and much cheaper
+    def _thumbnail(self, path: str, frame: int) -> np.ndarray:
+        container = self._container(path)
+        stream = container.streams.video[0]
+        container.seek(int(frame/60/stream.time_base), stream=stream)
+        decodedFrame = next(container.decode(stream))
+        width = max(1, round(decodedFrame.width /
+                    decodedFrame.height*THUMBNAIL_HEIGHT))
+        return decodedFrame.to_ndarray(width=width, height=THUMBNAIL_HEIGHT, format="rgba")
+
+
+thumbnailcache = ThumbnailCache()
@@ -1,8 +1,11 @@
-from PySide6.QtCore import QPointF, QRectF, Qt
-from PySide6.QtGui import QColor, QPen
+from math import ceil, floor, log2
+
+from PySide6.QtCore import QLineF, QPointF, QRectF, Qt
+from PySide6.QtGui import QColor, QFont, QImage, QPen
 from PySide6.QtWidgets import QGraphicsItem, QGraphicsSceneMouseEvent
 
 from czeditor.keyframes import Keyframe
+from czeditor.thumbnails import thumbnailcache
 
 
 class TimelineDurationLineItem(QGraphicsItem):
@@ -13,6 +16,8 @@ class TimelineDurationLineItem(QGraphicsItem):
         self.keyframe = keyframe
         self.setPos(self.keyframe.frame, -self.keyframe.layer*25)
         self.setCursor(Qt.CursorShape.IBeamCursor)
+        self.setFlag(
+            QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption, True)
 
     def boundingRect(self) -> QRectF:
         return QRectF(0, -4, self.params.params.duration(), 4)
@@ -20,11 +25,35 @@ class TimelineDurationLineItem(QGraphicsItem):
     def paint(self, painter, option, widget):
         self.setPos(self.keyframe.frame, -self.keyframe.layer *
                     25+self.params.params.transient().handleHeight)
+        if hasattr(self.params.function(), "waveform"):
+            self.paintWaveform(painter, option)
         painter.setPen(QPen(QColor(255, 255, 255), 0))
         painter.drawLine(QPointF(0, 0), QPointF(
             self.params.params.duration(), 0))
         # print(self.params.params.duration())
 
+    # Draws min/max lines with one line per pixel of the visible part
+    def paintWaveform(self, painter, option):
+        peaks = self.params.function().waveform(self.params.params)
+        if (peaks is None):
+            return
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        columns = int(exposed.width()*painter.worldTransform().m11())
+        if (columns <= 0):
+            return
+        startsample = int((self.params.params.startframe() +
+                          exposed.left())/60*peaks.samplerate)
+        endsample = int((self.params.params.startframe() +
+                        exposed.right())/60*peaks.samplerate)
+        minimum, maximum, rms = peaks.query(startsample, endsample, columns)
+        step = exposed.width()/columns
+        painter.setPen(QPen(QColor(96, 160, 255), 0))
+        painter.drawLines([QLineF(exposed.left()+i*step, -2-maximum[i]*2, exposed.left()+i*step, -2-minimum[i]*2)
+                           for i in range(columns)])
+        painter.setPen(QPen(QColor(160, 208, 255), 0))
+        painter.drawLines([QLineF(exposed.left()+i*step, -2-rms[i]*2, exposed.left()+i*step, -2+rms[i]*2)
+                           for i in range(columns)])
+
     def mousePressEvent(self, event: QGraphicsSceneMouseEvent) -> None:
         scenepos = event.scenePos().toPoint()
         durationAfterKeyframe = scenepos.x()-self.keyframe.frame
@@ -164,3 +193,70 @@ class TimelineStartFrameHandleItem(QGraphicsItem):
                     self.params.params.transient().handleHeight)
 
         event.accept()
+
+
+class TimelineProxyStateItem(QGraphicsItem):
+    def __init__(self, params, windowClass, keyframe):
+        super().__init__(None)
+        self.params = params
+        self.windowClass = windowClass
+        self.keyframe = keyframe
+        self.setPos(self.keyframe.frame, -self.keyframe.layer*25)
+        self.setFlag(
+            QGraphicsItem.GraphicsItemFlag.ItemIgnoresTransformations, True)
+
+    def boundingRect(self) -> QRectF:
+        return QRectF(4, -16, 120, 12)
+
+    def paint(self, painter, option, widget):
+        self.setPos(self.keyframe.frame, -self.keyframe.layer *
+                    25+self.params.params.transient().handleHeight)
+        painter.setPen(QPen(QColor(192, 192, 192), 0))
+        painter.setFont(QFont("Arial", 7))
+        painter.drawText(QRectF(4, -16, 120, 12), "Proxy: "+self.params.params.transient().proxystate,
+                         Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter)
+
+
+class TimelineThumbnailStripItem(QGraphicsItem):
+    stripheight = 18
+    # Thumbnails are never squeezed closer than this on screen
+    minimumspacing = 64
+
+    def __init__(self, params, windowClass, keyframe):
+        super().__init__(None)
+        self.params = params
+        self.windowClass = windowClass
+        self.keyframe = keyframe
+        self.setPos(self.keyframe.frame, -self.keyframe.layer*25)
+        self.setFlag(
+            QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption, True)
+
+    def boundingRect(self) -> QRectF:
+        return QRectF(0, -self.stripheight-4, self.params.params.duration(), self.stripheight)
+
+    def paint(self, painter, option, widget):
+        self.setPos(self.keyframe.frame, -self.keyframe.layer *
+                    25+self.params.params.transient().handleHeight)
+        reader = self.params.params.transient().pyavobject
+        scale = painter.worldTransform().m11()
+        if (reader is None or scale <= 0):
+            return
+        thumbnailwidth = self.stripheight*reader.resolution[0]/reader.resolution[1]
+        # Power of two spacing, so the same thumbnails are reused while zooming
+        interval = 2**ceil(log2(max(1, thumbnailwidth,
+                           self.minimumspacing/scale)))
+        startframe = self.params.params.startframe()
+        exposed = option.exposedRect
+        first = max(startframe, floor((startframe+exposed.left())/interval)*interval)
+        last = min(startframe+self.params.params.duration(),
+                   startframe+exposed.right())
+        sourceframe = first
+        while sourceframe <= last:
+            thumbnail = thumbnailcache.get(
+                self.params.params.videopath(), sourceframe)
+            if (thumbnail is not None):
+                image = QImage(thumbnail.data, thumbnail.shape[1], thumbnail.shape[0],
+                               thumbnail.shape[1]*4, QImage.Format.Format_RGBA8888)
+                painter.drawImage(QRectF(sourceframe-startframe, -self.stripheight-4,
+                                         thumbnailwidth, self.stripheight), image)
+            sourceframe += interval
@@ -14,6 +14,9 @@ from czeditor.keyframes import *
 from czeditor.actionfunctions import *
 from czeditor.util import *
 from czeditor.animation_keyframes import *
+from czeditor.mediapool import mediapool
+from czeditor.pcmcache import pcmcache
+from czeditor.thumbnails import thumbnailcache
 
 playbackframe = 100
 
@@ -781,6 +784,10 @@ class CzeTimeline(QWidget):
 
     def timerEvent(self, event) -> None:
         self.updateSeekingState()
+        # Thumbnails and waveforms are generated in the background, show them once they are ready
+        if thumbnailcache.takechanged() | pcmcache.takechanged():
+            self.scene.update()
+        mediapool.sweep()
         return super().timerEvent(event)
 
     def sizeHint(self):
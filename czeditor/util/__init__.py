@@ -112,6 +112,14 @@ def dummyfunction(*args, **kwargs):
     pass
 
 
+# Largest power of two downscale of a resolution that still covers the given size
+def coveringlevel(resolution, size, maxlevel=8):
+    level = 0
+    while (level < maxlevel and resolution[0] >> (level+1) >= size[0] and resolution[1] >> (level+1) >= size[1]):
+        level += 1
+    return level
+
+
 class StringList():
     def __init__(self, initial):
         self.list = initial
@@ -0,0 +1,52 @@
+import hashlib
+import json
+import os
+
+from PySide6.QtCore import QFileInfo, QStandardPaths
+
+from czeditor.util import Params, Selectable, StringList, emptylist
+
+CACHE_FOLDER_NAME = "czeditor"
+
+
+# Returns (and creates) a folder inside the user's cache directory
+def getCacheDirectory(*subdirectories: str) -> str:
+    path = os.path.join(QStandardPaths.writableLocation(
+        QStandardPaths.StandardLocation.GenericCacheLocation), CACHE_FOLDER_NAME, *subdirectories)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+# Identifies the contents of a file by its canonical path, size and mtime.
+# Any change to the file produces a different key, so stale cache entries are never reused.
+def fileKey(path: str) -> str:
+    canonical = QFileInfo(path).canonicalFilePath()
+    stat = os.stat(canonical)
+    return hashlib.sha1(f"{canonical}|{stat.st_size}|{stat.st_mtime_ns}".encode("utf-8")).hexdigest()
+
+
+# Plain JSON-able form of a value, raises TypeError for values without a stable form
+def _canonical(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _canonical(item) for key, item in value.items()}
+    if isinstance(value, Params):
+        # Transient values are caches and decoders, not inputs
+        return {key: _canonical(item) for key, item in vars(value).items() if key != "transient"}
+    if isinstance(value, Selectable):
+        return _canonical(value())
+    if isinstance(value, StringList):
+        return _canonical(value.list)
+    if isinstance(value, emptylist):
+        return {"emptylist": _canonical(value.default)}
+    if hasattr(value, "_val"):  # Properties
+        return _canonical(value._val)
+    raise TypeError(f"{type(value).__name__} has no stable hash")
+
+
+# Hash of values that stays the same between sessions, unlike hash()
+def stableHash(*values) -> str:
+    return hashlib.sha1(json.dumps(_canonical(values), sort_keys=True).encode("utf-8")).hexdigest()
@@ -0,0 +1,83 @@
+import concurrent.futures
+import os
+import threading
+import traceback
+
+CACHE_NONE = "none"
+CACHE_PENDING = "pending"
+CACHE_READY = "ready"
+CACHE_FAILED = "failed"
+
+
+# Files made from media files in the background (proxies, decoded audio, thumbnails) and kept in the user cache.
+# States are keyed by the path of the made file, which callers name after fileKey, so a changed source is never reported as ready.
+class BackgroundFileCache:
+    # Files left from an earlier session count as ready without a job, otherwise a job still runs generated() for them
+    readywhenexists = True
+
+    def __init__(self, workers=1):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+        self._states = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+
+    def state(self, path: str) -> str:
+        with self._lock:
+            if self.readywhenexists and path not in self._states and os.path.exists(path):
+                self._states[path] = CACHE_READY
+            return self._states.get(path, CACHE_NONE)
+
+    # Starts making the file with generate(temporarypath, *args) in the background if it does not exist yet
+    def request(self, path: str, generate, *args) -> str:
+        with self._lock:
+            state = self._states.get(path, CACHE_NONE)
+            if (state == CACHE_NONE and self.readywhenexists and os.path.exists(path)):
+                state = self._states[path] = CACHE_READY
+            if (state != CACHE_NONE):
+                return state
+            self._states[path] = CACHE_PENDING
+        self._executor.submit(self._run, path, generate, args)
+        return CACHE_PENDING
+
+    # Drops what is known about the file, the next request checks the disk again
+    def forget(self, path: str):
+        with self._lock:
+            self._states.pop(path, None)
+
+    # True once after any file finished, so the timeline knows to repaint
+    def takechanged(self) -> bool:
+        if (self._changed.is_set()):
+            self._changed.clear()
+            return True
+        return False
+
+    # Runs in the worker once the file exists, subclasses load or process it here
+    def generated(self, path: str, *args):
+        pass
+
+    def _run(self, path: str, generate, args: tuple):
+        existed = os.path.exists(path)
+        temporarypath = path+".tmp"
+        try:
+            if (not existed):
+                generate(temporarypath, *args)
+                # Written under another name first, a crash never leaves a half written file behind
+                os.replace(temporarypath, path)
+            self.generated(path, *args)
+            state = CACHE_READY
+        except Exception:
+            traceback.print_exc()
+            if (os.path.exists(temporarypath)):
+                os.remove(temporarypath)
+            state = CACHE_FAILED
+            if (existed and os.path.exists(path)):
+                # A file from an earlier session that cannot be used, it is made again on the next request
+                os.remove(path)
+                state = CACHE_NONE
+        with self._lock:
+            if (state == CACHE_NONE):
+                self._states.pop(path, None)
+            else:
+                self._states[path] = state
+        self._changed.set()
@@ -0,0 +1,154 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+# Bytes all caches together are allowed to hold
+CACHE_BUDGET = 1024*1024*1024
+
+
+# Size of a cached value in bytes
+def sizeof(value) -> int:
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, Image.Image):
+        return value.width*value.height*len(value.getbands())
+    if isinstance(value, (tuple, list)):
+        return sum(sizeof(item) for item in value)
+    return 0
+
+
+def _mtime(path: str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+# Least recently used cache limited by the amount of bytes it holds rather than by the amount of entries.
+# Every cache of the editor is a namespace of the same service, so they share one budget.
+class CacheService:
+    def __init__(self, budget: int):
+        self._budget = budget
+        # (namespace name, key) -> (value, size, path, mtime), least recently used first
+        self._entries = OrderedDict()
+        self._namespaces = {}
+        self._lock = threading.RLock()
+        self.bytes = 0
+
+    # Returns the namespace with that name, creating it the first time.
+    # budget optionally limits the namespace to less than the whole budget.
+    def namespace(self, name: str, budget: int = None):
+        with self._lock:
+            if name not in self._namespaces:
+                self._namespaces[name] = CacheNamespace(self, name, budget)
+            return self._namespaces[name]
+
+    # Hits, misses, bytes and entries of every namespace
+    def stats(self) -> dict:
+        with self._lock:
+            return {name: {"hits": namespace.hits, "misses": namespace.misses, "bytes": namespace.bytes, "entries": len(namespace)}
+                    for name, namespace in self._namespaces.items()}
+
+    def setbudget(self, budget: int):
+        with self._lock:
+            self._budget = budget
+            self._evict()
+
+    def clear(self):
+        for namespace in list(self._namespaces.values()):
+            namespace.clear()
+
+    def _get(self, namespace, key, default):
+        with self._lock:
+            entry = self._entries.get((namespace.name, key))
+            if entry is not None and entry[2] is not None and _mtime(entry[2]) != entry[3]:
+                # The file the value was made from changed since
+                self._pop(namespace, key)
+                entry = None
+            if entry is None:
+                namespace.misses += 1
+                return default
+            self._entries.move_to_end((namespace.name, key))
+            namespace._keys.move_to_end(key)
+            namespace.hits += 1
+            return entry[0]
+
+    def _put(self, namespace, key, value, path):
+        size = sizeof(value)
+        with self._lock:
+            if (namespace.name, key) in self._entries:
+                self._pop(namespace, key)
+            if size <= min(self._budget, namespace._budget or self._budget):
+                self._entries[(namespace.name, key)] = (
+                    value, size, path, None if path is None else _mtime(path))
+                namespace._keys[key] = None
+                namespace.bytes += size
+                self.bytes += size
+                self._evict(namespace)
+        return value
+
+    def _pop(self, namespace, key):
+        size = self._entries.pop((namespace.name, key))[1]
+        del namespace._keys[key]
+        namespace.bytes -= size
+        self.bytes -= size
+
+    def _evict(self, namespace=None):
+        while namespace is not None and namespace._budget is not None and namespace.bytes > namespace._budget:
+            self._pop(namespace, next(iter(namespace._keys)))
+        while self.bytes > self._budget:
+            name, key = next(iter(self._entries))
+            self._pop(self._namespaces[name], key)
+
+
+# One cache of the service with its own keys and statistics
+class CacheNamespace:
+    def __init__(self, service: CacheService, name: str, budget: int = None):
+        self._service = service
+        self._budget = budget
+        self._keys = OrderedDict()
+        self.name = name
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        return self._service._get(self, key, default)
+
+    def __contains__(self, key) -> bool:
+        return key in self._keys
+
+    # If path is given the entry is dropped once the file's mtime changes
+    def put(self, key, value, path: str = None):
+        return self._service._put(self, key, value, path)
+
+    # Returns the cached value, or creates and caches it with default()
+    def getorcreate(self, key, default, path: str = None):
+        value = self.get(key, self)
+        if value is self:
+            value = self.put(key, default(), path)
+        return value
+
+    # Drops every entry for which predicate(key, value) is true
+    def discard(self, predicate):
+        with self._service._lock:
+            for key in list(self._keys):
+                if predicate(key, self._service._entries[(self.name, key)][0]):
+                    self._service._pop(self, key)
+
+    def setbudget(self, budget: int):
+        with self._service._lock:
+            self._budget = budget
+            self._service._evict(self)
+
+    def clear(self):
+        self.discard(lambda key, value: True)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+cacheservice = CacheService(CACHE_BUDGET)